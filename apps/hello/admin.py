@@ -3,9 +3,18 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
-from .models import Contact, RequestsStore, NoteModel
+from .models import Contact, RequestPath, RequestsStore
+from .models import RequestRollup, NoteModel
+
+
+class RequestRollupAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'request_path', 'method', 'hits')
+    list_filter = ('method',)
+    date_hierarchy = 'hour'
 
 
 admin.site.register(Contact)
+admin.site.register(RequestPath)
 admin.site.register(RequestsStore)
+admin.site.register(RequestRollup, RequestRollupAdmin)
 admin.site.register(NoteModel)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping that keeps at most maxsize keys,
+    the least recently used key is evicted first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# path -> id of its RequestPath
+path_cache = LRUCache(settings.REQUEST_PATH_CACHE_SIZE)
+
+# rendered home_page by variant, anonymous or authenticated
+HOME_PAGE_KEY = 'hello:home_page:%s'
+
+
+def home_page_key(request):
+    # requests that skipped AuthenticationMiddleware are anonymous
+    user = getattr(request, 'user', None)
+    return HOME_PAGE_KEY % ('authenticated' if user is not None and
+                            user.is_authenticated() else 'anonymous')
+
+
+def clear_home_page():
+    cache.delete_many([HOME_PAGE_KEY % variant
+                       for variant in ('anonymous', 'authenticated')])
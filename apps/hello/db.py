@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+
+def set_pragmas(cursor, pragmas):
+    """
+    Runs PRAGMA name = value for (name, value) pairs on a DB-API cursor
+    of a sqlite connection. journal_mode can't change inside
+    a transaction, so it is meant for new connections.
+    """
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
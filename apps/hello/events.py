@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+
+class Notifier(object):
+    """
+    Lets threads of this process sleep until something changed.
+    Every notify bumps version, so a waiter that was busy while it
+    happened doesn't miss it.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Waits until version changes or timeout passes, returns it."""
+        with self._condition:
+            if self.version == version:
+                self._condition.wait(timeout)
+            return self.version
+
+
+# notified after logged requests, their unread count or priorities change
+request_log_changed = Notifier()
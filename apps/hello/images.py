@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import StringIO
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+
+from PIL import Image as Img
+
+from apps.hello.cache import clear_home_page
+
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Threads of this process making thumbnails, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.IMAGE_POOL_SIZE)
+        return _pool
+
+
+def decode(data, bound=None):
+    """
+    Image of data. A JPEG is decoded at 1/2, 1/4 or 1/8 scale when
+    that still covers a bound x bound thumbnail, which is much less
+    work and memory for large photos.
+    """
+    image = Img.open(StringIO.StringIO(data))
+    if bound is not None:
+        image.draft('RGB', (bound, bound))
+    image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    return image
+
+
+def thumbnails(data, bounds, draft=True):
+    """
+    JPEGs of at most bound x bound keeping aspect ratio, and their
+    sizes, by bound. data is decoded once, at reduced scale unless
+    draft is off, and made smaller step by step from the largest bound.
+    """
+    image = decode(data, max(bounds) if draft else None)
+    result = {}
+    for bound in sorted(bounds, reverse=True):
+        image.thumbnail((bound, bound), Img.ANTIALIAS)
+        output = StringIO.StringIO()
+        image.save(output, format='JPEG', quality=75)
+        result[bound] = output.getvalue(), image.size
+    return result
+
+
+def variant_name(name, width):
+    """Storage name of the photo name variant width pixels wide."""
+    root, ext = os.path.splitext(name)
+    return '%s-%dw%s' % (root, width, ext)
+
+
+def process_image(contact_id, name):
+    """
+    Replaces the raw upload name of a contact with its
+    CONTACT_IMAGE_SIZE thumbnail, stores a variant of every other
+    CONTACT_IMAGE_SIZES width next to it and marks the contact ready,
+    or failed when the upload is not an image. Returns the contact
+    fields it set.
+    """
+    from .models import Contact, image_seconds, images_total
+
+    started = time.time()
+    storage = Contact._meta.get_field('image').storage
+    fields = {}
+    try:
+        photo = storage.open(name)
+        try:
+            data = photo.read()
+        finally:
+            photo.close()
+        size = settings.CONTACT_IMAGE_SIZE
+        made = thumbnails(data, set(settings.CONTACT_IMAGE_SIZES) |
+                          set([size]))
+        content, (width, height) = made.pop(size)
+        widths = set([width])
+        # a small photo comes out the same for several bounds
+        for content_, (width_, height_) in made.values():
+            if width_ not in widths:
+                widths.add(width_)
+                storage.save(variant_name(name, width_),
+                             ContentFile(content_))
+        # HelloStorage writes over the raw upload
+        storage.save(name, ContentFile(content))
+        fields.update(width=width, height=height, image_widths=','.join(
+            '%d' % width_ for width_ in sorted(widths)))
+    except Exception:
+        logger.exception('Photo %s of contact %s is not processed'
+                         % (name, contact_id))
+        state = Contact.FAILED
+        images_total.labels('failed').inc()
+    else:
+        state = Contact.READY
+        image_seconds.observe(time.time() - started)
+        images_total.labels('resized').inc()
+
+    fields['image_state'] = state
+    # a newer upload has its own job
+    Contact.objects.filter(pk=contact_id, image=name).update(**fields)
+    clear_home_page()
+    return fields
+
+
+def _process_in_pool(contact_id, name):
+    try:
+        process_image(contact_id, name)
+    except Exception:
+        logger.exception('Photo %s of contact %s is not processed'
+                         % (name, contact_id))
+    finally:
+        # pool threads hold no request to close their connection
+        close_old_connections()
+
+
+def schedule(contact_id, name):
+    """
+    Makes the thumbnail in the pool with IMAGE_ASYNC, returns None.
+    Otherwise makes it right away and returns process_image result.
+    """
+    if settings.IMAGE_ASYNC:
+        get_pool().apply_async(_process_in_pool, (contact_id, name))
+        return None
+    return process_image(contact_id, name)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import StringIO
+import resource
+import time
+from multiprocessing import Process, Queue
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from PIL import Image as Img
+
+from apps.hello.images import decode, thumbnails
+
+
+def measure(queue, data, bounds, draft, repeat):
+    """
+    Runs in its own process, so peak memory is of this decode only:
+    puts decode and thumbnails ms, decoded size and memory growth.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    decoding, making = [], []
+    for i in range(repeat):
+        started = time.time()
+        image = decode(data, max(bounds) if draft else None)
+        decoding.append(time.time() - started)
+        started = time.time()
+        thumbnails(data, bounds, draft)
+        making.append(time.time() - started)
+    queue.put({
+        'decode': min(decoding) * 1000,
+        'thumbnails': min(making) * 1000,
+        'size': image.size,
+        'pixels': len(image.getbands()) * image.size[0] * image.size[1],
+        # kilobytes on Linux
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    })
+
+
+class Command(BaseCommand):
+    help = "Make a large JPEG and time its full decode against the "\
+           "reduced scale draft decode of Contact photos, with memory "\
+           "of the decoded pixels and peak memory growth."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--width', type='int', default=6000,
+                    help='Width of the photo'),
+        make_option('--height', type='int', default=4000,
+                    help='Height of the photo'),
+        make_option('--repeat', type='int', default=3,
+                    help='How many times every decode is timed'),
+    )
+
+    def handle(self, **options):
+        size = (options['width'], options['height'])
+        # noise compresses badly, as much work for the decoder as a photo
+        image = Img.merge('RGB', [Img.effect_noise(size, 64)
+                                  for band in 'RGB'])
+        output = StringIO.StringIO()
+        image.save(output, format='JPEG', quality=90)
+        data = output.getvalue()
+        del image
+        bounds = set(settings.CONTACT_IMAGE_SIZES) | set(
+            [settings.CONTACT_IMAGE_SIZE])
+
+        self.stdout.write('%dx%d JPEG, %.1f MB, thumbnails of %s px'
+                          % (size + (len(data) / 1e6, ', '.join(
+                              '%d' % bound for bound in sorted(bounds)))))
+        self.stdout.write('\n%-8s %10s %14s %12s %11s %11s' % (
+            'Decode', 'Decode ms', 'Thumbnails ms', 'Decoded', 'Pixels MB',
+            'Peak +MB'))
+        for name, draft in (('full', False), ('draft', True)):
+            queue = Queue()
+            process = Process(target=measure, args=(
+                queue, data, bounds, draft, options['repeat']))
+            process.start()
+            result = queue.get()
+            process.join()
+            self.stdout.write('%-8s %10.1f %14.1f %12s %11.1f %11.1f' % (
+                name, result['decode'], result['thumbnails'],
+                '%dx%d' % result['size'], result['pixels'] / 1e6,
+                result['rss'] / 1024.))
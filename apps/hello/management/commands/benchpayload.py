@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import random
+import time
+from optparse import make_option
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from apps.hello.models import RequestPath, RequestsStore
+from apps.hello.views import request_columns, serialize_requests
+
+
+class Command(BaseCommand):
+    help = "Seed request log rows and compare time and size of "\
+           "request_ajax payload formats. Everything is rolled back "\
+           "at the end."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000,
+                    help='Number of RequestsStore rows to seed'),
+        make_option('--limit', type='int', default=10,
+                    help='Number of requests in a payload'),
+        make_option('--repeat', type='int', default=200,
+                    help='How many times every payload is built'),
+    )
+
+    def handle(self, **options):
+        with transaction.atomic():
+            self.seed(options['rows'])
+            results = [
+                (label, self.measure(build, options['limit'],
+                                     options['repeat']))
+                for label, build in self.formats()]
+
+            transaction.set_rollback(True)
+
+        self.stdout.write('%d rows, %d requests per payload\n'
+                          % (options['rows'], options['limit']))
+        for label, (ms, size) in results:
+            self.stdout.write('%-12s %9.3f ms  %6d bytes' % (label, ms, size))
+
+    def seed(self, rows):
+        paths = [RequestPath.objects.create(path='/bench/%d/' % i)
+                 for i in range(100)]
+        RequestsStore.objects.bulk_create([
+            RequestsStore(request_path=random.choice(paths),
+                          method=random.choice(('GET', 'POST')))
+            for i in range(rows)])
+
+    def formats(self):
+        """Payload builders: label, function of the request count."""
+        def serializer(limit):
+            request_list = RequestsStore.objects.all()[:limit]
+            return json.dumps(serializers.serialize('json', request_list))
+
+        def payload(limit):
+            request_list = RequestsStore.objects\
+                .select_related('request_path')[:limit]
+            return json.dumps((0, serialize_requests(request_list)))
+
+        def columns(limit):
+            request_list = RequestsStore.objects.all()[:limit]
+            return json.dumps(request_columns(request_list),
+                              cls=DjangoJSONEncoder, separators=(',', ':'))
+
+        return [
+            ('serializers', serializer),
+            ('payload', payload),
+            ('columns', columns),
+        ]
+
+    def measure(self, build, limit, repeat):
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            data = build(limit)
+            timings.append(time.time() - start)
+        return min(timings) * 1000, len(data)
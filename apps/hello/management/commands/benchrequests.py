@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import time
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.hello.models import RequestPath, RequestsStore
+
+
+def count_sql(queryset):
+    query = queryset.query.clone()
+    query.clear_ordering(True)
+    query.add_count_column()
+    query.default_cols = False
+    return query.sql_with_params()
+
+
+def quote(param):
+    if isinstance(param, basestring):
+        return "'%s'" % param.replace("'", "''")
+    return param
+
+
+class Command(BaseCommand):
+    help = "Seed request log rows, show query plans and timings of "\
+           "the request log queries without and with its indexes. "\
+           "Everything is rolled back at the end."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=100000,
+                    help='Number of RequestsStore rows to seed'),
+        make_option('--paths', type='int', default=100,
+                    help='Number of distinct paths of the seeded rows'),
+        make_option('--repeat', type='int', default=20,
+                    help='How many times every query is timed'),
+    )
+
+    def handle(self, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('EXPLAIN QUERY PLAN needs sqlite database')
+
+        with transaction.atomic():
+            path = self.seed(options['rows'], options['paths'])
+            cursor = connection.cursor()
+            cases = self.cases(path)
+            indexed = self.measure(cursor, cases, options['repeat'])
+            self.reset_indexes(cursor)
+            plain = self.measure(cursor, cases, options['repeat'])
+
+            transaction.set_rollback(True)
+
+        self.stdout.write('%d rows, %d paths\n'
+                          % (options['rows'], options['paths']))
+        for (label, sql, run), before, after in zip(cases, plain, indexed):
+            self.stdout.write(label)
+            self.stdout.write('  ' + sql[0] % tuple(map(quote, sql[1])))
+            for name, (ms, plan) in (('without indexes', before),
+                                     ('with indexes', after)):
+                self.stdout.write('  %-16s %9.3f ms  %s'
+                                  % (name + ':', ms, plan))
+
+    def seed(self, rows, paths):
+        request_paths = [
+            RequestPath.objects.create(path='/bench/%d/' % i)
+            for i in range(paths)]
+        now = timezone.now()
+        batch = []
+        for i in range(rows):
+            batch.append(RequestsStore(
+                request_path=random.choice(request_paths),
+                method=random.choice(('GET', 'GET', 'GET', 'POST')),
+                date=now - timedelta(seconds=rows - i),
+                # only the newest requests are not viewed yet
+                new_request=int(i >= rows * 0.99)))
+            if len(batch) == 10000:
+                RequestsStore.objects.bulk_create(batch)
+                batch = []
+        RequestsStore.objects.bulk_create(batch)
+        return request_paths[0]
+
+    def cases(self, path):
+        """Queries of request_ajax and RequestMiddle: label, sql, run."""
+        unread = RequestsStore.objects.filter(new_request=1)
+        latest = RequestsStore.objects.select_related('request_path')[:10]
+        history = RequestsStore.objects.filter(request_path=path)[:10]
+        lookup = RequestPath.objects.filter(path=path.path)
+        return [
+            ('unread count', count_sql(unread), unread.count),
+            ('latest requests', latest.query.sql_with_params(),
+             lambda: list(latest.all())),
+            ('path history', history.query.sql_with_params(),
+             lambda: list(history.all())),
+            ('path lookup', lookup.query.sql_with_params(),
+             lambda: list(lookup.all())),
+        ]
+
+    def measure(self, cursor, cases, repeat):
+        results = []
+        for label, (sql, params), run in cases:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = '; '.join(row[-1] for row in cursor.fetchall())
+            timings = []
+            for i in range(repeat):
+                start = time.time()
+                run()
+                timings.append(time.time() - start)
+            results.append((min(timings) * 1000, plan))
+        return results
+
+    def reset_indexes(self, cursor):
+        """
+        Puts RequestsStore indexes back to what they were before
+        migration 0011: only foreign key ones.
+        """
+        qn = connection.ops.quote_name
+        table = RequestsStore._meta.db_table
+        cursor.execute('PRAGMA index_list(%s)' % qn(table))
+        for name in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('PRAGMA index_info(%s)' % qn(name))
+            columns = set(row[2] for row in cursor.fetchall())
+            if columns & set(['date', 'new_request', 'request_path_id']):
+                cursor.execute('DROP INDEX %s' % qn(name))
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+            qn(table + '_request_path_id'), qn(table),
+            qn('request_path_id')))
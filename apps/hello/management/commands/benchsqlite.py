@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import Queue
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.hello.db import set_pragmas
+from apps.hello.models import RequestCounter, RequestPath, RequestsStore
+
+
+# name, pragmas, log rows go through one writer thread
+MODES = (
+    ('sqlite defaults', False, False),
+    ('SQLITE_PRAGMAS', True, False),
+    ('SQLITE_PRAGMAS, one writer', True, True),
+)
+
+STORE = RequestsStore._meta.db_table
+PATH = RequestPath._meta.db_table
+COUNTER = RequestCounter._meta.db_table
+
+LOG_SQL = 'INSERT INTO %s (request_path_id, method, date, new_request, '\
+          'weight) VALUES (?, ?, ?, 1, 1)' % STORE
+UNREAD_SQL = 'UPDATE %s SET value = value + ? WHERE name = ?' % COUNTER
+READ_SQL = (
+    'SELECT value FROM %s WHERE name = ?' % COUNTER,
+    'SELECT s.id, s.method, s.date, p.path FROM %s s JOIN %s p '
+    'ON s.request_path_id = p.id ORDER BY s.date DESC LIMIT 10'
+    % (STORE, PATH),
+)
+# request_ajax POST takes the next PRIORITIES version, then updates the
+# path, writing first
+PRIORITY_SQL = (
+    'UPDATE %s SET value = value + 1 WHERE name = ?' % COUNTER,
+    'UPDATE %s SET priority = ? WHERE id = ?' % PATH,
+)
+
+
+def is_locked(error):
+    return 'locked' in unicode(error) or 'busy' in unicode(error)
+
+
+class Workload(object):
+    """
+    Threads running what the site runs: page reads of request_ajax,
+    priority changes and request log inserts.
+    """
+
+    def __init__(self, path, pragmas, one_writer, paths, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.one_writer = one_writer
+        self.paths = paths
+        self.counts = dict.fromkeys(
+            ('reads', 'priorities', 'logged', 'locked'), 0)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.stopped = threading.Event()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout,
+                             isolation_level=None, check_same_thread=False)
+        if self.pragmas:
+            set_pragmas(db.cursor(), settings.SQLITE_PRAGMAS)
+        return db
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def transaction(self, db, statements):
+        """Runs statements in a transaction, False when locked."""
+        cursor = db.cursor()
+        try:
+            cursor.execute('BEGIN')
+            for sql, params in statements:
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            cursor.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            if not is_locked(e):
+                raise
+            try:
+                cursor.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                # failed BEGIN, nothing to roll back
+                pass
+            self.count('locked')
+            return False
+        return True
+
+    def log_statements(self, rows):
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        return [(LOG_SQL, (random.choice(self.paths), 'GET', now))
+                for i in range(rows)] + \
+            [(UNREAD_SQL, (rows, RequestCounter.UNREAD))]
+
+    def request(self, writes):
+        db = self.connect()
+        try:
+            while not self.stopped.is_set():
+                choice = random.random()
+                if choice < writes:
+                    if self.one_writer:
+                        self.queue.put(1)
+                    elif self.transaction(db, self.log_statements(1)):
+                        self.count('logged')
+                elif choice < writes + 0.05:
+                    path = random.choice(self.paths)
+                    if self.transaction(db, [
+                            (PRIORITY_SQL[0], (RequestCounter.PRIORITIES,)),
+                            (PRIORITY_SQL[1], (random.randint(0, 5),
+                                               path))]):
+                        self.count('priorities')
+                else:
+                    if self.transaction(db, [(READ_SQL[0],
+                                              (RequestCounter.UNREAD,)),
+                                             (READ_SQL[1], ())]):
+                        self.count('reads')
+        finally:
+            db.close()
+
+    def writer(self):
+        """Single writer, inserts what is queued a batch at a time."""
+        db = self.connect()
+        try:
+            while not self.stopped.is_set() or not self.queue.empty():
+                rows = 0
+                try:
+                    rows += self.queue.get(timeout=0.05)
+                    while rows < settings.REQUEST_LOG_BATCH_SIZE:
+                        rows += self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                while rows and not self.transaction(
+                        db, self.log_statements(rows)):
+                    pass
+                self.count('logged', rows)
+        finally:
+            db.close()
+
+    def run(self, threads, seconds, writes):
+        workers = [threading.Thread(target=self.request, args=(writes,))
+                   for i in range(threads)]
+        if self.one_writer:
+            workers.append(threading.Thread(target=self.writer))
+        for worker in workers:
+            worker.start()
+        time.sleep(seconds)
+        self.stopped.set()
+        for worker in workers:
+            worker.join()
+        return self.counts
+
+
+class Command(BaseCommand):
+    help = "Run request log inserts, request_ajax reads and priority "\
+           "changes from concurrent threads on a copy of the sqlite "\
+           "schema, with sqlite defaults, with SQLITE_PRAGMAS and with "\
+           "request log rows written by one thread, and report "\
+           "throughput and \"database is locked\" errors."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=8,
+                    help='Request threads'),
+        make_option('--seconds', type='float', default=5,
+                    help='Run time of every mode'),
+        make_option('--rows', type='int', default=10000,
+                    help='Number of request log rows to seed'),
+        make_option('--writes', type='float', default=0.5,
+                    help='Part of operations that log a request'),
+        make_option('--timeout', type='float', default=5,
+                    help='Seconds a connection waits for a lock, as '
+                    'DATABASES OPTIONS timeout, busy_timeout of '
+                    'SQLITE_PRAGMAS overrides it'),
+    )
+
+    def handle(self, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('benchsqlite needs sqlite database')
+
+        self.stdout.write(
+            '%(threads)d threads, %(seconds)s seconds per mode, '
+            '%(rows)d rows, %(writes)s of operations log a request'
+            % options)
+        self.stdout.write('\n%-28s %9s %9s %9s %9s %8s' % (
+            'Mode', 'Reads/s', 'Prior/s', 'Logged/s', 'Locked', 'Locked%'))
+
+        directory = tempfile.mkdtemp()
+        try:
+            for number, (name, pragmas, one_writer) in enumerate(MODES):
+                # a new database per mode, WAL stays on once set
+                path = os.path.join(directory, '%d.sqlite3' % number)
+                paths = self.create(path, options['rows'])
+                counts = Workload(path, pragmas, one_writer, paths,
+                                  options['timeout']).run(
+                    options['threads'], options['seconds'],
+                    options['writes'])
+                done = counts['reads'] + counts['priorities'] + \
+                    counts['logged']
+                self.stdout.write('%-28s %9.1f %9.1f %9.1f %9d %7.2f%%' % (
+                    name, counts['reads'] / options['seconds'],
+                    counts['priorities'] / options['seconds'],
+                    counts['logged'] / options['seconds'], counts['locked'],
+                    100. * counts['locked'] / (done + counts['locked'] or 1)))
+        finally:
+            shutil.rmtree(directory)
+
+    def create(self, path, rows):
+        """Database with the request log tables, returns path ids."""
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name IN (%s, %s, %s) "
+            "AND sql IS NOT NULL", (STORE, PATH, COUNTER))
+        schema = [row[0] for row in cursor.fetchall()]
+
+        db = sqlite3.connect(path, isolation_level=None)
+        try:
+            for sql in schema:
+                db.execute(sql)
+            db.execute('BEGIN')
+            db.executemany(
+                'INSERT INTO %s (path, priority, version) VALUES (?, 0, 0)'
+                % PATH, [('/bench/%d/' % i,) for i in range(100)])
+            paths = [row[0] for row in
+                     db.execute('SELECT id FROM %s' % PATH)]
+            date = time.strftime('%Y-%m-%d %H:%M:%S')
+            db.executemany(LOG_SQL, [(random.choice(paths), 'GET', date)
+                                     for i in range(rows)])
+            db.executemany('INSERT INTO %s (name, value) VALUES (?, ?)'
+                           % COUNTER, [(RequestCounter.UNREAD, rows),
+                                       (RequestCounter.PRIORITIES, 0)])
+            db.execute('COMMIT')
+        finally:
+            db.close()
+        return paths
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import glob
+import json
+import logging
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from apps.hello.models import RequestCounter, RequestsStore
+from apps.middleware.writers import request_row
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Load closed request log segments written by the file "\
+           "backend into RequestsStore, a transaction per segment, "\
+           "and delete them."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', dest='directory',
+                    default=settings.REQUEST_LOG_FILE_DIR,
+                    help='Directory of the segments'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Rows inserted by one query'),
+        make_option('--keep', action='store_true', default=False,
+                    help="Don't delete imported segments"),
+    )
+
+    def handle(self, **options):
+        # segment names start with their creation time
+        segments = sorted(glob.glob(
+            os.path.join(options['directory'], '*.jsonl')))
+
+        total = 0
+        for segment in segments:
+            total += self.load(segment, options['batch_size'])
+            # a segment is deleted after its rows are committed,
+            # a crash in between makes the next run import it again
+            if not options['keep']:
+                os.remove(segment)
+            logger.info('%s imported' % segment)
+
+        self.stdout.write('%d requests imported from %d segments'
+                          % (total, len(segments)))
+
+    @transaction.atomic
+    def load(self, segment, batch_size):
+        count = 0
+        rows = []
+        with open(segment, 'rb') as lines:
+            for number, line in enumerate(lines, 1):
+                try:
+                    record = json.loads(line)
+                    record['date'] = parse_datetime(record['date'])
+                    if record['date'] is None:
+                        raise ValueError('not a date')
+                    rows.append(request_row(record))
+                # TypeError: JSON other than an object, [1] or "x"
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    logger.warning('%s:%d is not a request record, skipped'
+                                   % (segment, number))
+                    continue
+                if len(rows) == batch_size:
+                    RequestsStore.objects.bulk_create(rows)
+                    count += len(rows)
+                    rows = []
+        RequestsStore.objects.bulk_create(rows)
+        count += len(rows)
+        # new rows are unread
+        RequestCounter.objects.incr(RequestCounter.UNREAD, count)
+        return count
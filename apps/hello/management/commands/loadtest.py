@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import random
+import threading
+import time
+import uuid
+from Cookie import SimpleCookie
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.core.urlresolvers import set_script_prefix
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from apps.hello.models import NoteModel, RequestCounter, RequestPath
+from apps.hello.models import RequestsStore
+from apps.hello.views import percentile
+from apps.middleware import writers
+
+
+PASSWORD = 'loadtest'
+
+# name, expected status
+SCENARIOS = (
+    ('home', 200),
+    ('requests', 200),
+    ('requests_ajax_get', 200),
+    ('requests_ajax_post', 200),
+    ('form', 200),
+    ('login', 302),
+)
+
+# compared with the baseline, a regression is a rise of latency or a fall
+# of throughput by more than the threshold
+LOWER_IS_BETTER = ('p50', 'p95', 'p99')
+HIGHER_IS_BETTER = ('throughput',)
+
+
+def summary(timings, errors, elapsed):
+    """Throughput and latency percentiles in ms of a scenario."""
+    timings = sorted(timing * 1000 for timing in timings)
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'throughput': len(timings) / elapsed if elapsed else 0,
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'max': timings[-1],
+    }
+
+
+def regressions(results, baseline, threshold):
+    """Metrics of scenarios worse than baseline by threshold percent."""
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            before, after = base[metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) * 100. / before
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                found.append((name, metric, before, after))
+    return found
+
+
+class Command(BaseCommand):
+    help = "Drive fortytwo_test_task.wsgi.application in-process with "\
+           "concurrent requests to the hello views over seeded request "\
+           "log and notes, report throughput and latency percentiles, "\
+           "save them as JSON and compare them with a baseline. Rows "\
+           "seeded and logged by the run are deleted at the end."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=200,
+                    help='Requests per scenario'),
+        make_option('--concurrency', type='int', default=4,
+                    help='Threads sending requests'),
+        make_option('--rows', type='int', default=10000,
+                    help='Number of RequestsStore rows to seed'),
+        make_option('--notes', type='int', default=1000,
+                    help='Number of NoteModel rows to seed'),
+        make_option('--scenario', action='append', dest='scenarios',
+                    default=[], help='Only this scenario, can be repeated: '
+                    + ', '.join(name for name, status in SCENARIOS)),
+        make_option('--output', help='Save results to this JSON file'),
+        make_option('--baseline',
+                    help='Compare results with this JSON file'),
+        make_option('--threshold', type='float', default=20,
+                    help='Regression threshold, percent'),
+    )
+
+    def handle(self, **options):
+        for option in ('requests', 'concurrency'):
+            if options[option] < 1:
+                raise CommandError('--%s should be at least 1' % option)
+        # imported here, loading it sets up the middleware
+        from fortytwo_test_task.wsgi import application
+        self.application = application
+
+        names = [name for name, status in SCENARIOS]
+        for name in options['scenarios']:
+            if name not in names:
+                raise CommandError('Unknown scenario %s, choose from %s'
+                                   % (name, ', '.join(names)))
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['scenarios']
+
+        # requests are sent under SCRIPT_NAME /loadtest/<run>, so rows
+        # logged by the run are told apart by their paths
+        self.run_id = uuid.uuid4().hex[:12]
+        self.prefix = '/loadtest/%s/' % self.run_id
+        self.username = 'loadtest-%s' % self.run_id
+        self.urls = dict((name, reverse(name)) for name in (
+            'hello:home', 'hello:requests', 'hello:requests_ajax',
+            'hello:form', 'login'))
+        self.script_prefix = get_script_prefix()
+        self.sessions = set()
+        self.notes = []
+        self.csrf_token = None
+        self.lock = threading.Lock()
+        post_save.connect(self.note_saved, sender=NoteModel,
+                          dispatch_uid='loadtest-%s' % self.run_id)
+        try:
+            self.seed(options['rows'], options['notes'])
+            self.prepare()
+            results = {}
+            for name, status in SCENARIOS:
+                if options['scenarios'] and name not in options['scenarios']:
+                    continue
+                results[name] = self.run(name, status, options['requests'],
+                                         options['concurrency'])
+        finally:
+            self.cleanup()
+
+        self.write_results(results, options)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'date': timezone.now().isoformat(),
+                    'options': dict((key, options[key]) for key in (
+                        'requests', 'concurrency', 'rows', 'notes')),
+                    'scenarios': results,
+                }, f, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            found = regressions(results, baseline, options['threshold'])
+            for name, metric, before, after in found:
+                self.stdout.write('REGRESSION %s %s: %.2f -> %.2f'
+                                  % (name, metric, before, after))
+            if found:
+                raise CommandError('%d regressions over %s%%'
+                                   % (len(found), options['threshold']))
+            self.stdout.write('No regressions over %s%%'
+                              % options['threshold'])
+
+    def note_saved(self, sender, instance, created, **kwargs):
+        # the command serves no other requests, so the notes saved in
+        # its process are those of the run
+        if created:
+            with self.lock:
+                self.notes.append(instance.id)
+
+    @transaction.atomic
+    def seed(self, rows, notes):
+        """Rows are bulk inserted, signals don't see them."""
+        RequestPath.objects.bulk_create([
+            RequestPath(path='%s%d/' % (self.prefix, i))
+            for i in range(100)])
+        paths = list(RequestPath.objects.filter(
+            path__startswith=self.prefix))
+        self.paths = [path.path for path in paths]
+        now = timezone.now()
+        unread = rows // 100
+        batch = []
+        for i in range(rows):
+            batch.append(RequestsStore(
+                request_path=random.choice(paths),
+                method=random.choice(('GET', 'GET', 'GET', 'POST')),
+                date=now - timedelta(seconds=rows - i),
+                new_request=int(i >= rows - unread)))
+            if len(batch) == 1000:
+                RequestsStore.objects.bulk_create(batch)
+                batch = []
+        RequestsStore.objects.bulk_create(batch)
+        # the rows are deleted one by one, and so counted down, at the end
+        RequestCounter.objects.incr(RequestCounter.UNREAD, unread)
+
+        NoteModel.objects.bulk_create([
+            NoteModel(model='LoadTest', inst='%s%d' % (self.prefix, i),
+                      action_type=i % 3) for i in range(notes)])
+
+        user = get_user_model()(username=self.username)
+        user.set_password(PASSWORD)
+        user.save()
+
+    def prepare(self):
+        """CSRF token and a session for views that need them."""
+        status, cookies = self.request(self.factory(), 'get',
+                                       self.urls['login'])
+        self.csrf_token = cookies['csrftoken']
+        status, cookies = self.request(
+            self.factory(), 'post', self.urls['login'],
+            {'username': self.username, 'password': PASSWORD,
+             'csrfmiddlewaretoken': self.csrf_token})
+        if 'sessionid' not in cookies:
+            raise CommandError('Log in failed with status %d' % status)
+        self.session_id = cookies['sessionid']
+
+    def factory(self, session=False):
+        factory = RequestFactory()
+        if self.csrf_token:
+            factory.cookies['csrftoken'] = self.csrf_token
+        if session:
+            factory.cookies['sessionid'] = self.session_id
+        return factory
+
+    def request(self, factory, method, path, data=None, **extra):
+        """Runs a request through the WSGI application: status, cookies."""
+        extra['SCRIPT_NAME'] = self.prefix.rstrip('/')
+        environ = getattr(factory, method)(path, data or {}, **extra).environ
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        result = self.application(environ, start_response)
+        try:
+            for chunk in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        cookies = {}
+        for name, value in response['headers']:
+            if name.lower() == 'set-cookie':
+                cookie = SimpleCookie(str(value))
+                cookies.update((key, morsel.value)
+                               for key, morsel in cookie.items())
+        if 'sessionid' in cookies:
+            with self.lock:
+                self.sessions.add(cookies['sessionid'])
+        return response['status'], cookies
+
+    def send(self, name, index):
+        ajax = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+        if name == 'home':
+            return self.request(self.factory(), 'get',
+                                self.urls['hello:home'])
+        if name == 'requests':
+            return self.request(self.factory(), 'get',
+                                self.urls['hello:requests'])
+        if name == 'requests_ajax_get':
+            return self.request(self.factory(), 'get',
+                                self.urls['hello:requests_ajax'],
+                                {'since_id': 0}, **ajax)
+        if name == 'requests_ajax_post':
+            return self.request(
+                self.factory(), 'post', self.urls['hello:requests_ajax'],
+                {'path': self.paths[index % len(self.paths)],
+                 'priority': index % 5},
+                HTTP_X_CSRFTOKEN=self.csrf_token, **ajax)
+        if name == 'form':
+            return self.request(self.factory(session=True), 'get',
+                                self.urls['hello:form'])
+        if name == 'login':
+            return self.request(
+                self.factory(), 'post', self.urls['login'],
+                {'username': self.username, 'password': PASSWORD,
+                 'csrfmiddlewaretoken': self.csrf_token})
+
+    def run(self, name, expected, requests, concurrency):
+        def timed(index):
+            started = time.time()
+            status, cookies = self.send(name, index)
+            return time.time() - started, status != expected
+
+        started = time.time()
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                results = pool.map(timed, range(requests))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(timed, range(requests))
+        elapsed = time.time() - started
+        return summary([timing for timing, error in results],
+                       sum(error for timing, error in results), elapsed)
+
+    def cleanup(self):
+        """
+        Deletes the rows of the run only. Deleting them one by one counts
+        unread requests down and notes the deletions, those notes are
+        deleted last.
+        """
+        # rows logged by the run may still be queued or buffered
+        writers.join()
+        # the WSGI handler set it for the requests
+        set_script_prefix(self.script_prefix)
+        with transaction.atomic():
+            RequestsStore.objects.filter(
+                request_path__path__startswith=self.prefix).delete()
+            RequestPath.objects.filter(path__startswith=self.prefix).delete()
+            Session.objects.filter(session_key__in=self.sessions).delete()
+            get_user_model().objects.filter(username=self.username).delete()
+            post_save.disconnect(sender=NoteModel,
+                                 dispatch_uid='loadtest-%s' % self.run_id)
+            NoteModel.objects.filter(
+                model='LoadTest', inst__startswith=self.prefix).delete()
+            # sqlite allows 999 parameters a query
+            for i in range(0, len(self.notes), 500):
+                NoteModel.objects.filter(
+                    id__in=self.notes[i:i + 500]).delete()
+
+    def write_results(self, results, options):
+        self.stdout.write(
+            '%(requests)d requests per scenario, concurrency '
+            '%(concurrency)d, %(rows)d rows, %(notes)d notes' % options)
+        self.stdout.write('\n%-20s %8s %7s %10s %9s %9s %9s %9s' % (
+            'Scenario', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms',
+            'p99 ms', 'max ms'))
+        for name, status in SCENARIOS:
+            if name in results:
+                self.stdout.write(
+                    '%(name)-20s %(requests)8d %(errors)7d '
+                    '%(throughput)10.1f %(p50)9.2f %(p95)9.2f %(p99)9.2f '
+                    '%(max)9.2f' % dict(results[name], name=name))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import glob
+import os
+import pstats
+from collections import defaultdict
+from StringIO import StringIO
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def view_name(filename):
+    # <view>-<time>-<pid>-<thread>.prof
+    return os.path.basename(filename).rsplit('-', 3)[0]
+
+
+class Command(BaseCommand):
+    help = "Merge .prof files written by ProfileMiddleware and print the "\
+           "functions of each view that take most time, cumulative and "\
+           "their own."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', dest='directory', default=settings.PROFILE_DIR,
+                    help='Directory of the profiles'),
+        make_option('--view', action='append', dest='views', default=[],
+                    help='Only this view, can be repeated'),
+        make_option('--top', type='int', default=20,
+                    help='Number of functions per listing'),
+    )
+
+    def handle(self, **options):
+        profiles = defaultdict(list)
+        for filename in glob.glob(
+                os.path.join(options['directory'], '*.prof')):
+            profiles[view_name(filename)].append(filename)
+        if options['views']:
+            profiles = dict((view, profiles[view])
+                            for view in options['views'] if view in profiles)
+        if not profiles:
+            raise CommandError('No profiles in %s' % options['directory'])
+
+        for view, filenames in sorted(profiles.items()):
+            # pstats prints pieces of lines, OutputWrapper would end each
+            out = StringIO()
+            stats = pstats.Stats(*filenames, stream=out)
+            stats.strip_dirs()
+            # instead of a line per merged file
+            stats.files = []
+            self.stdout.write('%s: %d profiled requests, %.3f s per request'
+                              % (view, len(filenames),
+                                 stats.total_tt / len(filenames)))
+            for order, title in (('cumulative', 'Cumulative time'),
+                                 ('tottime', 'Self time')):
+                self.stdout.write('\n%s' % title)
+                stats.sort_stats(order).print_stats(options['top'])
+                self.stdout.write(out.getvalue().strip('\n'))
+                out.seek(0)
+                out.truncate()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import glob
+import json
+import mmap
+import os
+from collections import Counter
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def empty_stats():
+    return {
+        'lines': 0,
+        'skipped': 0,
+        'paths': Counter(),
+        'methods': Counter(),
+        'minutes': Counter(),
+        'users': set(),
+    }
+
+
+def scan(filename):
+    """
+    Counts requests of a JSON lines file by path, method and minute and
+    collects its user ids. The file is mapped into memory and read line
+    by line, so only the counters grow with it.
+    """
+    stats = empty_stats()
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return stats
+        lines = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(lines.readline, b''):
+                stats['lines'] += 1
+                try:
+                    record = json.loads(line)
+                    weight = record.get('weight', 1)
+                    stats['paths'][record['path']] += weight
+                    stats['methods'][record['method']] += weight
+                    # ISO date up to minutes: 2016-03-01T10:15
+                    stats['minutes'][record['date'][:16]] += weight
+                    if record.get('user_id') is not None:
+                        stats['users'].add(record['user_id'])
+                # AttributeError: JSON other than an object, [1] or "x"
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    stats['skipped'] += 1
+        finally:
+            lines.close()
+    return stats
+
+
+def merge(total, stats):
+    for key in ('lines', 'skipped'):
+        total[key] += stats[key]
+    for key in ('paths', 'methods', 'minutes'):
+        total[key].update(stats[key])
+    total['users'] |= stats['users']
+    return total
+
+
+class Command(BaseCommand):
+    args = '<file or directory ...>'
+    help = "Report top paths, methods, requests per minute and unique "\
+           "users of request log JSON lines files, REQUEST_LOG_FILE_DIR "\
+           "segments by default, without loading them into memory."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='table',
+                    choices=['table', 'csv', 'json'],
+                    help='Output format: table, csv or json'),
+        make_option('--top', type='int', default=10,
+                    help='Number of top paths'),
+        make_option('--processes', type='int', default=1,
+                    help='Scan files in that many processes'),
+    )
+
+    def handle(self, *args, **options):
+        filenames = self.find_files(args or [settings.REQUEST_LOG_FILE_DIR])
+
+        if options['processes'] > 1 and len(filenames) > 1:
+            pool = Pool(options['processes'])
+            try:
+                results = pool.map(scan, filenames)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(scan, filenames)
+        stats = reduce(merge, results, empty_stats())
+
+        report = self.report(stats, len(filenames), options['top'])
+        getattr(self, 'write_' + options['format'])(report)
+
+    def find_files(self, names):
+        filenames = []
+        for name in names:
+            if os.path.isdir(name):
+                filenames.extend(sorted(
+                    glob.glob(os.path.join(name, '*.jsonl')) +
+                    glob.glob(os.path.join(name, '*.jsonl.part'))))
+            elif os.path.isfile(name):
+                filenames.append(name)
+            else:
+                raise CommandError('%s is not a file or directory' % name)
+        return filenames
+
+    def report(self, stats, files, top):
+        minutes = sorted(stats['minutes'].items())
+        requests = sum(stats['methods'].values())
+        return {
+            'files': files,
+            'lines': stats['lines'],
+            'skipped': stats['skipped'],
+            'requests': requests,
+            'unique_users': len(stats['users']),
+            'paths': stats['paths'].most_common(top),
+            'methods': stats['methods'].most_common(),
+            'minutes': minutes,
+            'peak_per_minute': max(stats['minutes'].values() or [0]),
+            'mean_per_minute': float(requests) / len(minutes)
+            if minutes else 0,
+        }
+
+    def write_json(self, report):
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def write_csv(self, report):
+        writer = csv.writer(self.stdout, lineterminator='\n')
+        writer.writerow(['section', 'key', 'value'])
+        for key in ('files', 'lines', 'skipped', 'requests', 'unique_users',
+                    'peak_per_minute', 'mean_per_minute'):
+            writer.writerow(['summary', key, report[key]])
+        for section in ('paths', 'methods', 'minutes'):
+            for key, value in report[section]:
+                writer.writerow([section, key.encode('utf-8'), value])
+
+    def write_table(self, report):
+        self.stdout.write(
+            '%(requests)d requests in %(lines)d lines of %(files)d files, '
+            '%(skipped)d lines skipped, %(unique_users)d unique users\n'
+            'requests per minute: %(peak_per_minute)d peak, '
+            '%(mean_per_minute).1f mean' % report)
+        for title, section in (('Path', 'paths'), ('Method', 'methods'),
+                               ('Minute', 'minutes')):
+            self.stdout.write('\n%-50s %10s' % (title, 'Requests'))
+            for key, value in report[section]:
+                self.stdout.write('%-50s %10d' % (key, value))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.hello.models import RequestCounter, RequestsStore, RequestRollup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Fold old requests into hourly per path and method counters "\
+           "and delete them. Every chunk is a transaction of its own, "\
+           "so the command can be stopped and run again at any moment."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int',
+                    default=settings.REQUEST_LOG_RETENTION_DAYS,
+                    help='Keep requests of that many last days'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=settings.REQUEST_LOG_ROLLUP_CHUNK,
+                    help='Requests folded per transaction'),
+        make_option('--sleep', type='float', default=0.05,
+                    help='Pause between chunks, lets other writers in'),
+    )
+
+    def handle(self, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        old = RequestsStore.objects.filter(date__lt=cutoff)\
+            .order_by('date')\
+            .values_list('id', 'request_path_id', 'method', 'date',
+                         'new_request', 'weight')
+
+        total = 0
+        while True:
+            rows = list(old[:options['chunk_size']])
+            if not rows:
+                break
+            self.rollup(rows)
+            total += len(rows)
+            logger.info('%d requests rolled up' % total)
+            time.sleep(options['sleep'])
+
+        self.stdout.write('%d requests older than %s rolled up'
+                          % (total, cutoff))
+
+    @transaction.atomic
+    def rollup(self, rows):
+        hits = Counter()
+        unread = 0
+        for pk, path_id, method, date, new_request, weight in rows:
+            unread += bool(new_request)
+            hour = date.replace(minute=0, second=0, microsecond=0)
+            hits[path_id, method, hour] += weight
+
+        created = []
+        for (path_id, method, hour), count in hits.items():
+            updated = RequestRollup.objects.filter(
+                request_path_id=path_id, method=method, hour=hour)\
+                .update(hits=F('hits') + count)
+            if not updated:
+                created.append(RequestRollup(
+                    request_path_id=path_id, method=method,
+                    hour=hour, hits=count))
+        # bulk_create sends no post_save, so no NoteModel entry
+        RequestRollup.objects.bulk_create(created)
+
+        # One DELETE for the chunk. delete() would load every request and
+        # send post_delete for it: a NoteModel entry and counter updates
+        # per row, holding the write lock several times longer. Nothing
+        # refers to requests, so the private _raw_delete loses nothing,
+        # the counters are updated once below.
+        RequestsStore.objects.filter(id__in=[row[0] for row in rows])\
+            ._raw_delete(using=RequestsStore.objects.db)
+        RequestCounter.objects.incr(RequestCounter.UNREAD, -unread)
+        RequestCounter.objects.incr(RequestCounter.CHANGES)
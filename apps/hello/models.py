@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import StringIO
 import os
 
-from django.db import models
+from django.db import models, IntegrityError
+from django.db.models import F
 from django.conf import settings
-from django.core.files.uploadedfile import InMemoryUploadedFile
-
-from PIL import Image as Img
+from django.utils import timezone
 
 from hello.storage import HelloStorage
+from apps.hello import images
+from apps.metrics.registry import registry
+
+
+image_seconds = registry.histogram(
+    'contact_image_seconds', 'Time of making a contact photo thumbnail')
+images_total = registry.counter(
+    'contact_images_total', 'Contact photos by result', ('result',))
 
 
 class Contact(models.Model):
@@ -34,30 +40,63 @@ class Contact(models.Model):
     height = models.PositiveIntegerField(default=1, null=True, blank=True)
     width = models.PositiveIntegerField(default=1,  null=True, blank=True)
 
+    READY = 'ready'
+    PROCESSING = 'processing'
+    FAILED = 'failed'
+    IMAGE_STATES = (
+        (READY, 'ready'),
+        (PROCESSING, 'processing'),
+        (FAILED, 'failed'),
+    )
+    # set by save() and the images pool, never by forms
+    image_state = models.CharField('photo state', max_length=10,
+                                   choices=IMAGE_STATES, default=READY,
+                                   editable=False)
+    # widths of the photo variants, see image_srcset
+    image_widths = models.CommaSeparatedIntegerField(
+        'photo widths', max_length=100, blank=True, editable=False)
+
     def save(self, *args, **kwargs):
-        if self.image:
-            try:
-                image = Img.open(StringIO.StringIO(self.image.read()))
-            except ValueError:
-                return super(Contact, self).save(*args, **kwargs)
-            image.thumbnail((200, 200), Img.ANTIALIAS)
-            output = StringIO.StringIO()
-            image.save(output, format='JPEG', quality=75)
-            output.seek(0)
-
-            self.image = InMemoryUploadedFile(output,
-                                              'ImageField',
-                                              "%s" % self.image.name,
-                                              'image/jpeg',
-                                              output.len,
-                                              None)
+        # a photo already in storage was made smaller when it was
+        # uploaded, encoding it again would only lose quality
+        new_image = bool(self.image) and not self.image._committed
+        if new_image:
+            # stored raw, the thumbnails are made in images pool
+            self.image_state = self.PROCESSING
+            self.image_widths = ''
+        elif self.image:
+            images_total.labels('unchanged').inc()
+        else:
+            self.image_state = self.READY
+            self.image_widths = ''
 
         super(Contact, self).save(*args, **kwargs)
 
+        if new_image:
+            fields = images.schedule(self.pk, self.image.name)
+            for name, value in (fields or {}).items():
+                setattr(self, name, value)
+
+    def image_variants(self):
+        """Storage name and width of every size of the photo."""
+        widths = [int(width) for width in self.image_widths.split(',')
+                  if width]
+        return [(self.image.name if width == self.width
+                 else images.variant_name(self.image.name, width), width)
+                for width in widths]
+
+    def image_srcset(self):
+        storage = self.image.storage
+        return ', '.join('%s %dw' % (storage.url(name), width)
+                         for name, width in self.image_variants())
+
     def delete(self, *args, **kwargs):
         if self.image:
             if os.path.isfile(self.image.path):
                 os.remove(self.image.path)
+            for name, width in self.image_variants():
+                if name != self.image.name:
+                    self.image.storage.delete(name)
 
         super(Contact, self).delete(*args, **kwargs)
 
@@ -65,21 +104,106 @@ class Contact(models.Model):
         return '%s %s' % (self.surname, self.name)
 
 
+class RequestPath(models.Model):
+    path = models.CharField(max_length=250, unique=True)
+    priority = models.PositiveIntegerField(default=0)
+    # RequestCounter.PRIORITIES value of the last priority change
+    version = models.PositiveIntegerField(default=0, db_index=True)
+
+    def __unicode__(self):
+        return self.path
+
+
 class RequestsStore(models.Model):
-    path = models.CharField(max_length=250)
+    # indexed together with date below
+    request_path = models.ForeignKey(RequestPath,
+                                     related_name='requests',
+                                     db_index=False)
     method = models.CharField(max_length=10)
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              blank=True,
                              null=True)
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(default=timezone.now, db_index=True)
     new_request = models.PositiveIntegerField(default=1)
-    priority = models.PositiveIntegerField(blank=True, null=True, default=0)
+    # number of requests the row stands for, see REQUEST_LOG_RULES
+    weight = models.PositiveIntegerField(default=1)
+    # response of the request: time in ms, status, bytes, db queries
+    duration = models.FloatField(null=True, blank=True)
+    status = models.PositiveSmallIntegerField(null=True, blank=True)
+    size = models.PositiveIntegerField(null=True, blank=True)
+    queries = models.PositiveIntegerField(null=True, blank=True)
+
+    def __init__(self, *args, **kwargs):
+        super(RequestsStore, self).__init__(*args, **kwargs)
+        # as stored, so a save marking the request read counts it down
+        self._new_request = self.new_request
 
     def __unicode__(self):
-        return "%s - %s" % (self.path, self.method)
+        return "%s - %s" % (self.request_path, self.method)
 
     class Meta:
         ordering = ["-date"]
+        # unread count and update, history of a path
+        index_together = [
+            ['new_request', 'date'],
+            ['request_path', 'date'],
+        ]
+
+
+class RequestRollup(models.Model):
+    """Number of requests of a path and method within an hour."""
+    request_path = models.ForeignKey(RequestPath, related_name='rollups')
+    method = models.CharField(max_length=10)
+    hour = models.DateTimeField(db_index=True)
+    hits = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s - %s %s: %d" % (
+            self.request_path, self.method, self.hour, self.hits)
+
+    class Meta:
+        ordering = ["-hour"]
+        unique_together = [['request_path', 'method', 'hour']]
+
+
+class CounterManager(models.Manager):
+    def value(self, name):
+        return self.filter(name=name).values_list('value', flat=True)\
+            .first() or 0
+
+    def incr(self, name, delta=1):
+        if self.filter(name=name).update(value=F('value') + delta):
+            return
+        try:
+            # bulk_create sends no post_save, so no NoteModel entry
+            self.bulk_create([self.model(name=name, value=delta)])
+        except IntegrityError:
+            self.filter(name=name).update(value=F('value') + delta)
+
+    def next(self, name):
+        """Increments the counter and returns its new value."""
+        self.incr(name)
+        return self.value(name)
+
+
+class RequestCounter(models.Model):
+    """
+    Named counter kept up to date on every write, so it is read with
+    one primary key lookup instead of a count over RequestsStore.
+    """
+    UNREAD = 'unread'
+    # bumped by priority changes, see RequestPath.version
+    PRIORITIES = 'priorities'
+    # bumped by edits and deletes of logged requests
+    CHANGES = 'changes'
+
+    name = models.CharField(max_length=50, unique=True)
+    value = models.IntegerField(default=0)
+
+    objects = CounterManager()
+
+    def __unicode__(self):
+        return "%s: %d" % (self.name, self.value)
 
 
 class NoteModel(models.Model):
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.conf import settings
+from django.db.backends.signals import connection_created
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import NoteModel
+from .db import set_pragmas
+from .models import Contact, NoteModel, RequestCounter, RequestPath
+from .models import RequestsStore
+from apps.hello.cache import clear_home_page, path_cache
+from apps.hello.events import request_log_changed
+from apps.metrics.registry import registry
+
+
+notes_total = registry.counter(
+    'notes_total', 'NoteModel entries by model and action',
+    ('model', 'action'))
 
 
 @receiver([post_save, post_delete],
@@ -27,3 +39,51 @@ def models_handler(sender, **kwargs):
                      inst=instance,
                      action_type=action_type)
     note.save()
+    notes_total.labels(sender.__name__,
+                       note.get_action_type_display()).inc()
+
+
+@receiver([post_save, post_delete], sender=Contact,
+          dispatch_uid='home_page_cache')
+def home_page_cache_handler(sender, **kwargs):
+    clear_home_page()
+
+
+@receiver(post_delete, sender=RequestPath,
+          dispatch_uid='request_path')
+def request_path_handler(sender, instance, **kwargs):
+    path_cache.delete(instance.path)
+
+
+@receiver(post_save, sender=RequestPath,
+          dispatch_uid='request_path_changes')
+def request_path_changes_handler(sender, instance, created, **kwargs):
+    if not created:
+        version = RequestCounter.objects.next(RequestCounter.PRIORITIES)
+        # update() sends no post_save
+        RequestPath.objects.filter(pk=instance.pk).update(version=version)
+        request_log_changed.notify()
+
+
+@receiver([post_save, post_delete], sender=RequestsStore,
+          dispatch_uid='request_unread')
+def request_unread_handler(sender, instance, **kwargs):
+    # the request log writer uses bulk_create and counts its rows itself
+    created = kwargs.get('created')
+    if not created:
+        RequestCounter.objects.incr(RequestCounter.CHANGES)
+    # created None: deleted
+    was_unread = not created and bool(instance._new_request)
+    is_unread = created is not None and bool(instance.new_request)
+    if is_unread != was_unread:
+        RequestCounter.objects.incr(RequestCounter.UNREAD,
+                                    is_unread - was_unread)
+    instance._new_request = instance.new_request
+    request_log_changed.notify()
+
+
+@receiver(connection_created, dispatch_uid='sqlite_pragmas')
+def sqlite_pragmas_handler(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        # the raw cursor, debug cursor would log the pragmas as queries
+        set_pragmas(connection.connection.cursor(), settings.SQLITE_PRAGMAS)
@@ -3,11 +3,26 @@ from __future__ import unicode_literals
 
 from django.test import TestCase
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.core import signals
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.db import close_old_connections
+from django.test.utils import override_settings
 from django.utils.six import StringIO
+from django.utils import timezone
 
-from datetime import date
+from datetime import date, datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
 
-from ..models import Contact
+from ..models import Contact, RequestPath, RequestsStore, RequestRollup
+from ..models import RequestCounter, NoteModel
+from ..cache import path_cache
+from apps.middleware.writers import FileWriter
 
 
 class CommandsTestCase(TestCase):
@@ -30,3 +45,247 @@ class CommandsTestCase(TestCase):
         # number of objects model Contact is 1, after contact is created
         call_command('showmodels', stdout=out, stderr=out)
         self.assertIn('Contact - 1', out.getvalue())
+
+    def test_benchrequests(self):
+        """Test benchrequests command."""
+        out = StringIO()
+        call_command('benchrequests', rows=50, paths=5, repeat=1, stdout=out)
+
+        self.assertIn('50 rows, 5 paths', out.getvalue())
+        self.assertIn('unread count', out.getvalue())
+        self.assertIn('without indexes:', out.getvalue())
+        self.assertIn('USING COVERING INDEX', out.getvalue())
+
+        # seeded rows are rolled back
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+    def test_benchpayload(self):
+        """Test benchpayload command."""
+        out = StringIO()
+        call_command('benchpayload', rows=20, limit=5, repeat=1, stdout=out)
+
+        self.assertIn('20 rows, 5 requests per payload', out.getvalue())
+        for label in ('serializers', 'payload', 'columns'):
+            self.assertIn(label, out.getvalue())
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+    def test_importrequests(self):
+        """Test importrequests command."""
+        path_cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        writer = FileWriter(directory=directory, batch_size=1, max_bytes=1)
+        for path in ('/', '/form/', '/'):
+            writer.add({'path': path, 'method': 'GET', 'user_id': None,
+                        'date': timezone.now(), 'weight': 1})
+        writer.close()
+        # sorted first, its lines are skipped and the next ones imported
+        with open(os.path.join(directory, 'requests-0.jsonl'), 'w') as f:
+            f.write('broken line\n[1]\n"x"\n{"path": "/"}\n'
+                    '{"path": "/", "method": "GET", "date": "yesterday"}\n')
+
+        out = StringIO()
+        call_command('importrequests', directory=directory, batch_size=2,
+                     stdout=out)
+        self.assertIn('3 requests imported from 4 segments', out.getvalue())
+        self.assertEqual(
+            sorted(RequestsStore.objects.values_list(
+                'request_path__path', flat=True)), ['/', '/', '/form/'])
+        self.assertEqual(
+            RequestCounter.objects.value(RequestCounter.UNREAD), 3)
+
+        # imported segments are deleted
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_requeststats(self):
+        """Test requeststats command."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        records = [
+            ('/', 'GET', 1, '2016-03-01T10:15:01Z', 1),
+            ('/', 'GET', None, '2016-03-01T10:15:30Z', 10),
+            ('/form/', 'POST', 1, '2016-03-01T10:16:00Z', 1),
+            ('/form/', 'GET', 2, '2016-03-01T10:16:10Z', 1),
+        ]
+        for number, part in enumerate((records[:2], records[2:])):
+            name = os.path.join(directory, 'requests-%d.jsonl' % number)
+            with open(name, 'w') as segment:
+                for path, method, user_id, when, weight in part:
+                    segment.write(json.dumps({
+                        'path': path, 'method': method, 'user_id': user_id,
+                        'date': when, 'weight': weight}) + '\n')
+                segment.write('broken line\n')
+                # valid JSON, but not an object
+                segment.write('[1]\n')
+
+        out = StringIO()
+        call_command('requeststats', directory, format='json', processes=2,
+                     stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['files'], 2)
+        self.assertEqual(report['skipped'], 4)
+        # sampled request counts with its weight
+        self.assertEqual(report['requests'], 13)
+        self.assertEqual(report['paths'], [['/', 11], ['/form/', 2]])
+        self.assertEqual(report['methods'], [['GET', 12], ['POST', 1]])
+        self.assertEqual(report['minutes'], [['2016-03-01T10:15', 11],
+                                             ['2016-03-01T10:16', 2]])
+        self.assertEqual(report['unique_users'], 2)
+
+        out = StringIO()
+        call_command('requeststats', directory, format='csv', top=1,
+                     stdout=out)
+        self.assertIn('paths,/,11\n', out.getvalue())
+        self.assertNotIn('paths,/form/', out.getvalue())
+
+    def test_rolluprequests(self):
+        """Test rolluprequests command."""
+        home = RequestPath.objects.create(path='/')
+        old = datetime(2016, 3, 1, 10, 15, tzinfo=timezone.utc)
+        for minutes in (0, 10, 20, 60):
+            RequestsStore.objects.create(
+                request_path=home, method='GET',
+                date=old + timedelta(minutes=minutes))
+        # sampled request standing for ten
+        RequestsStore.objects.create(request_path=home, method='POST',
+                                     date=old, weight=10)
+        recent = RequestsStore.objects.create(request_path=home,
+                                              method='GET')
+
+        notes = NoteModel.objects.count()
+
+        out = StringIO()
+        call_command('rolluprequests', days=1, chunk_size=2, sleep=0,
+                     stdout=out)
+        self.assertIn('5 requests older than', out.getvalue())
+
+        # only recent request is kept, old ones are counted per hour
+        self.assertQuerysetEqual(RequestsStore.objects.all(),
+                                 [repr(recent)])
+        rollups = RequestRollup.objects.order_by('hour', 'method')\
+            .values_list('method', 'hour', 'hits')
+        self.assertEqual(list(rollups), [
+            ('GET', old.replace(minute=0), 3),
+            ('POST', old.replace(minute=0), 10),
+            ('GET', old.replace(hour=11, minute=0), 1),
+        ])
+        # no NoteModel entry per rollup or deleted request
+        self.assertEqual(NoteModel.objects.count(), notes)
+        self.assertFalse(NoteModel.objects.filter(
+            model='RequestsStore', action_type=2).exists())
+
+        # rolled up requests are not unread anymore
+        self.assertEqual(
+            RequestCounter.objects.value(RequestCounter.UNREAD), 1)
+
+        # next run has nothing to do
+        call_command('rolluprequests', days=1, stdout=out)
+        self.assertIn('0 requests older than', out.getvalue())
+
+    def test_profilestats(self):
+        """Test profilestats command."""
+        path_cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.settings(PROFILE_RATE=1, PROFILE_DIR=directory):
+            for i in range(2):
+                self.client.get(reverse('hello:home'))
+            self.client.get(reverse('hello:form'))
+
+        out = StringIO()
+        call_command('profilestats', directory=directory, views=['home_page'],
+                     top=5, stdout=out)
+        self.assertIn('home_page: 2 profiled requests', out.getvalue())
+        self.assertNotIn('form_page', out.getvalue())
+        self.assertIn('Cumulative time', out.getvalue())
+        self.assertIn('Self time', out.getvalue())
+        self.assertIn('home_page', out.getvalue())
+
+        empty = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, empty)
+        with self.assertRaises(CommandError):
+            call_command('profilestats', directory=empty, stdout=out)
+
+    @override_settings(PASSWORD_HASHERS=(
+        'django.contrib.auth.hashers.MD5PasswordHasher',))
+    def test_loadtest(self):
+        """Test loadtest command."""
+        path_cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'results.json')
+        # rows of other users and an earlier run are kept
+        user = get_user_model().objects.create(username='loadtest')
+        path = RequestPath.objects.create(path='/loadtest/1/')
+        RequestsStore.objects.create(request_path=path, method='GET')
+        counts = [model.objects.count() for model
+                  in (RequestsStore, RequestPath, NoteModel, Session)]
+        unread = RequestCounter.objects.value(RequestCounter.UNREAD)
+
+        # as the test client does, connections are closed after requests
+        # of the WSGI handler otherwise
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+        self.addCleanup(signals.request_started.connect,
+                        close_old_connections)
+        self.addCleanup(signals.request_finished.connect,
+                        close_old_connections)
+        out = StringIO()
+        call_command('loadtest', requests=3, concurrency=1, rows=200,
+                     notes=5, output=output, stdout=out)
+
+        for name in ('home', 'requests', 'requests_ajax_get',
+                     'requests_ajax_post', 'form', 'login'):
+            self.assertRegexpMatches(out.getvalue(),
+                                     r'%s +3 +0 ' % name)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(results['scenarios']['home']['requests'], 3)
+
+        # seeded and logged rows are deleted
+        self.assertEqual(counts, [model.objects.count() for model in (
+            RequestsStore, RequestPath, NoteModel, Session)])
+        self.assertEqual(
+            RequestCounter.objects.value(RequestCounter.UNREAD), unread)
+        self.assertEqual(list(get_user_model().objects.filter(
+            username__startswith='loadtest')), [user])
+        self.assertTrue(RequestPath.objects.filter(
+            path='/loadtest/1/').exists())
+        self.assertEqual(reverse('hello:home'), '/')
+
+        # much faster baseline
+        for result in results['scenarios'].values():
+            result['throughput'] *= 10
+        with open(output, 'w') as f:
+            json.dump(results, f)
+        with self.assertRaises(CommandError):
+            call_command('loadtest', requests=3, concurrency=1, rows=20,
+                         notes=5, scenarios=['home'], baseline=output,
+                         stdout=out)
+        self.assertIn('REGRESSION home throughput', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('loadtest', requests=0, stdout=out)
+
+    def test_benchsqlite(self):
+        """Test benchsqlite command."""
+        out = StringIO()
+        call_command('benchsqlite', threads=2, seconds=0.2, rows=50,
+                     stdout=out)
+
+        self.assertIn('2 threads, 0.2 seconds per mode', out.getvalue())
+        for mode in ('sqlite defaults', 'SQLITE_PRAGMAS',
+                     'SQLITE_PRAGMAS, one writer'):
+            self.assertIn(mode, out.getvalue())
+
+    def test_benchimages(self):
+        """Test benchimages command."""
+        out = StringIO()
+        call_command('benchimages', width=1600, height=1200, repeat=1,
+                     stdout=out)
+
+        self.assertIn('1600x1200 JPEG', out.getvalue())
+        self.assertIn('thumbnails of 100, 200, 400 px', out.getvalue())
+        self.assertRegexpMatches(out.getvalue(), r'full .* 1600x1200 ')
+        # decoded at 1/4 scale, just as wide as the 400 px thumbnail
+        self.assertRegexpMatches(out.getvalue(), r'draft .* 400x300 ')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+
+from django.test import TestCase
+from django.core.urlresolvers import reverse
+
+from apps.metrics.multiprocess import ARCHIVE, MmapStore
+from apps.metrics.registry import Registry
+from ..models import RequestsStore
+from ..cache import path_cache
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_threads(self):
+        """Test counter sums increments of every thread."""
+        counter = self.registry.counter('hits_total', 'Hits', ('view',))
+
+        def hit():
+            for i in range(1000):
+                counter.labels('home').inc()
+        threads = [threading.Thread(target=hit) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.labels(view='form').inc(2)
+
+        self.assertIn('hits_total{view="home"} 4000', self.registry.render())
+        self.assertIn('hits_total{view="form"} 2', self.registry.render())
+
+        # same family by name
+        self.assertIs(self.registry.counter('hits_total', 'Hits'), counter)
+        with self.assertRaises(ValueError):
+            self.registry.gauge('hits_total', 'Hits')
+        with self.assertRaises(ValueError):
+            counter.labels('home', 'GET')
+
+    def test_counter_thread_per_request(self):
+        """Test lists of finished threads are folded into the total."""
+        counter = self.registry.counter('hits_total', 'Hits')
+        for i in range(50):
+            thread = threading.Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+
+        self.assertLessEqual(len(counter.labels()._cells._cells), 1)
+        self.assertIn('hits_total 50', self.registry.render())
+
+    def test_histogram(self):
+        """Test histogram counts observations in cumulative buckets."""
+        histogram = self.registry.histogram('took_seconds', 'Took',
+                                            buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines, [
+            '# HELP took_seconds Took',
+            '# TYPE took_seconds histogram',
+            'took_seconds_bucket{le="0.1"} 2',
+            'took_seconds_bucket{le="1"} 3',
+            'took_seconds_bucket{le="+Inf"} 4',
+            'took_seconds_sum 3.65',
+            'took_seconds_count 4',
+        ])
+
+    def test_gauge(self):
+        """Test gauge value and gauge read from a function."""
+        gauge = self.registry.gauge('queue', 'Queue', ('state',))
+        gauge.labels('pending').set(5)
+        gauge.labels('pending').dec()
+        gauge.labels('dropped').set_function(lambda: 7)
+        self.assertIn('queue{state="pending"} 4', self.registry.render())
+        self.assertIn('queue{state="dropped"} 7', self.registry.render())
+
+
+class MmapRegistryTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def worker(self, function):
+        """Runs function in a forked worker process, returns its pid."""
+        pid = os.fork()
+        if not pid:
+            try:
+                function(self.make_registry())
+            finally:
+                os._exit(0)
+        return pid
+
+    def make_registry(self):
+        registry = Registry(MmapStore(self.directory))
+        registry.counter('hits_total', 'Hits', ('view',))
+        registry.gauge('busy', 'Busy')
+        registry.histogram('took_seconds', 'Took', buckets=(0.1, 1))
+        return registry
+
+    def test_workers(self):
+        """Test values of worker processes are merged at scrape."""
+        registry = self.make_registry()
+        registry.counter('hits_total', 'Hits').labels('home').inc()
+
+        def work(registry):
+            registry.counter('hits_total', 'Hits').labels('home').inc(2)
+            registry.counter('hits_total', 'Hits').labels('form').inc()
+            registry.gauge('busy', 'Busy').set(3)
+            registry.histogram('took_seconds', 'Took').observe(0.5)
+            # stays alive until the scrape below is done
+            os.read(read_end, 1)
+        read_end, write_end = os.pipe()
+        pid = self.worker(work)
+
+        # wait until the worker wrote its values
+        for i in range(1000):
+            if 'busy 3' in registry.render():
+                break
+            threading.Event().wait(0.01)
+        lines = registry.render().splitlines()
+        self.assertIn('hits_total{view="home"} 3', lines)
+        self.assertIn('hits_total{view="form"} 1', lines)
+        self.assertIn('busy 3', lines)
+        self.assertIn('took_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('took_seconds_sum 0.5', lines)
+
+        os.write(write_end, b'x')
+        os.waitpid(pid, 0)
+        os.close(read_end)
+        os.close(write_end)
+
+        # counters and histograms of a dead worker are archived,
+        # its gauges are dropped
+        lines = registry.render().splitlines()
+        self.assertIn('hits_total{view="home"} 3', lines)
+        self.assertIn('took_seconds_count 1', lines)
+        self.assertIn('busy 0', lines)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([
+            ARCHIVE, ARCHIVE + '.lock', 'metrics-%d.db' % os.getpid()]))
+
+        # the archive is added to only once
+        registry.counter('hits_total', 'Hits').labels('home').inc()
+        self.assertIn('hits_total{view="home"} 4',
+                      registry.render().splitlines())
+
+
+class MetricsViewTest(TestCase):
+    def setUp(self):
+        path_cache.clear()
+
+    def test_metrics_view(self):
+        """Test /metrics shows metrics fed by RequestMiddle."""
+        self.client.get(reverse('hello:home'))
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4')
+        self.assertContains(response, '# TYPE http_requests_total counter')
+        self.assertContains(
+            response,
+            'http_requests_total{view="home_page",method="GET",status="200"}')
+        self.assertContains(
+            response, 'http_request_duration_seconds_bucket{view="home_page"')
+
+        # metrics requests are not logged
+        self.assertEqual(RequestsStore.objects.count(), 1)
@@ -1,22 +1,58 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
 from django.test import TestCase
+from django.http import HttpResponse
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
 from django.test.client import RequestFactory
+from django.db import connection
+from django.test.utils import override_settings
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
 
 from apps.middleware.helloRequest import RequestMiddle
-from ..models import RequestsStore
+from apps.middleware.profiling import ProfileMiddleware
+from apps.middleware.queries import normalize
+from apps.middleware.rules import RequestRules
+from apps.middleware import writers
+from apps.middleware.writers import BufferedWriter, FileWriter, QueueWriter
+from ..models import RequestCounter, RequestPath, RequestsStore
+from ..cache import LRUCache, path_cache
+from ..events import Notifier
 from ..decorator import not_record_request
 from ..views import home_page
 
 
+def record(method, path='/'):
+    """Request record as RequestMiddle hands it to writers."""
+    return {'path': path, 'method': method, 'user_id': None,
+            'date': timezone.now(), 'weight': 1}
+
+
+def log_request(middleware, request, view):
+    """Runs request through every RequestMiddle hook."""
+    middleware.process_request(request)
+    middleware.process_view(request, view)
+    return middleware.process_response(request, HttpResponse('ok'))
+
+
 class RequestMiddlewareTests(TestCase):
     fixtures = ['data.json']
 
     def setUp(self):
+        path_cache.clear()
         self.factory = RequestFactory()
         self.middleware = RequestMiddle()
         self.request_store = RequestsStore
@@ -27,7 +63,8 @@ class RequestMiddlewareTests(TestCase):
         self.client.get(reverse('hello:home'))
         last_middleware_obj = self.request_store.objects.last()
         self.assertEqual(last_middleware_obj.method, 'GET')
-        self.assertEqual(last_middleware_obj.path, reverse('hello:home'))
+        self.assertEqual(last_middleware_obj.request_path.path,
+                         reverse('hello:home'))
 
     def test_middleware(self):
         """Test middleware RequestMiddle."""
@@ -36,22 +73,456 @@ class RequestMiddlewareTests(TestCase):
         # middleware don't store request to decorated function
         decorated_func = not_record_request(home_page)
         request.user = self.user
-        self.middleware.process_view(request,  decorated_func)
+        log_request(self.middleware, request, decorated_func)
         rs = RequestsStore.objects.all()
         self.assertQuerysetEqual(rs, [])
 
         # middleware store request to undecorated function
         request.user = self.user
-        self.middleware.process_view(request, home_page)
+        log_request(self.middleware, request, home_page)
         rs = self.request_store.objects.all()
         self.assertEquals(len(rs), 1)
         only_one_rs = rs[0]
-        self.assertEqual(only_one_rs.path, reverse('hello:home'))
+        self.assertEqual(only_one_rs.request_path.path,
+                         reverse('hello:home'))
 
         # if user is anonymous
         request.user = AnonymousUser()
-        self.middleware.process_view(request, home_page)
+        log_request(self.middleware, request, home_page)
         rs = self.request_store.objects.all()
         self.assertEquals(len(rs), 2)
         only_one_rs = rs[1]
-        self.assertEqual(only_one_rs.path, reverse('hello:home'))
+        self.assertEqual(only_one_rs.request_path.path,
+                         reverse('hello:home'))
+
+    def test_middleware_path_cache(self):
+        """Test middleware reads path id from db only once."""
+        RequestPath.objects.create(path='/', priority=3)
+        # created by migration 0014
+        RequestCounter.objects.incr(RequestCounter.UNREAD, 0)
+        request = self.factory.get(reverse('hello:home'))
+        request.user = AnonymousUser()
+
+        # first request looks path up, inserts the row and counts it
+        # in a savepoint
+        with self.assertNumQueries(5):
+            log_request(self.middleware, request, home_page)
+        # next ones only insert and count the row
+        with self.assertNumQueries(4):
+            log_request(self.middleware, request, home_page)
+        self.assertEqual(RequestPath.objects.get().requests.count(), 2)
+
+    def test_middleware_response_timings(self):
+        """Test middleware stores time, status, size and query count."""
+        response = self.client.get(reverse('hello:home'))
+        self.client.get('/form/')
+
+        home, form = RequestsStore.objects.order_by('id')
+        self.assertGreater(home.duration, 0)
+        self.assertEqual(home.status, 200)
+        self.assertEqual(home.size, len(response.content))
+        # contact of home page
+        self.assertEqual(home.queries, 1)
+        # login redirect
+        self.assertEqual(form.status, 302)
+
+    @override_settings(REQUEST_LOG_QUERIES=False)
+    def test_middleware_no_queries(self):
+        """Test queries aren't counted without REQUEST_LOG_QUERIES."""
+        self.client.get(reverse('hello:home'))
+
+        home = RequestsStore.objects.get()
+        self.assertEqual(home.status, 200)
+        self.assertIsNone(home.queries)
+        self.assertFalse(connection.use_debug_cursor)
+
+
+class QueryAccountingTests(TestCase):
+    def setUp(self):
+        path_cache.clear()
+        self.middleware = RequestMiddle()
+        self.request = RequestFactory().get(reverse('hello:home'))
+        self.request.user = AnonymousUser()
+
+    def test_normalize(self):
+        """Test statements differing by parameters normalize equal."""
+        self.assertEqual(
+            normalize("SELECT * FROM a WHERE id = 12 AND b = 'x''y'"),
+            'SELECT * FROM a WHERE id = ? AND b = ?')
+        self.assertEqual(normalize('SELECT 1 WHERE id IN (1, 2,3)'),
+                         normalize('SELECT 7 WHERE id IN (5)'))
+        # sqlite debug cursor
+        self.assertEqual(
+            normalize("QUERY = u'SELECT a FROM b WHERE c IN (%s, %s)' "
+                      "- PARAMS = (1, 2)"),
+            'SELECT a FROM b WHERE c IN (...)')
+
+    def run_queries(self, count):
+        """Logs a request running count queries, returns response."""
+        handler = LogCapture()
+        logger = logging.getLogger('apps.middleware.helloRequest')
+        logger.addHandler(handler)
+        try:
+            self.middleware.process_request(self.request)
+            self.middleware.process_view(self.request, home_page)
+            for i in range(count):
+                list(RequestPath.objects.filter(id=i))
+            response = self.middleware.process_response(
+                self.request, HttpResponse('ok'))
+        finally:
+            logger.removeHandler(handler)
+        return response, handler.warnings
+
+    @override_settings(QUERY_BUDGET=3, QUERY_REPEAT_LIMIT=4,
+                       QUERY_HEADERS=True)
+    def test_budget(self):
+        """Test requests over the query budget are reported."""
+        response, warnings = self.run_queries(2)
+        self.assertEqual(warnings, [])
+        self.assertEqual(response['X-Query-Count'], '2')
+        self.assertFalse(response.has_header('X-Query-Repeats'))
+
+        response, warnings = self.run_queries(5)
+        self.assertEqual(response['X-Query-Count'], '5')
+        self.assertEqual(response['X-Query-Repeats'], '5')
+        self.assertEqual(warnings[0], 'GET / ran 5 queries, budget is 3')
+        self.assertIn('GET / repeated 5 times: SELECT', warnings[1])
+        self.assertIn('"id" = ?', warnings[1])
+
+    @override_settings(QUERY_HEADERS=False)
+    def test_no_headers(self):
+        """Test query headers are off without QUERY_HEADERS."""
+        response, warnings = self.run_queries(1)
+        self.assertFalse(response.has_header('X-Query-Count'))
+
+    @override_settings(QUERY_ACCOUNTING=False, QUERY_BUDGET=3,
+                       QUERY_REPEAT_LIMIT=4, QUERY_HEADERS=True)
+    def test_no_accounting(self):
+        """Test queries are only counted without QUERY_ACCOUNTING."""
+        response, warnings = self.run_queries(5)
+        self.assertEqual(warnings, [])
+        self.assertFalse(response.has_header('X-Query-Count'))
+        self.assertEqual(self.request._log_record['queries'], 5)
+
+
+class LogCapture(logging.Handler):
+    """Keeps messages of warnings."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.warnings = []
+
+    def emit(self, record):
+        self.warnings.append(record.getMessage())
+
+
+class ProfileMiddlewareTests(TestCase):
+    def setUp(self):
+        path_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profiles(self):
+        return sorted(os.path.basename(name).split('-')[0] for name
+                      in glob.glob(os.path.join(self.directory, '*.prof')))
+
+    def test_not_used(self):
+        """Test ProfileMiddleware is off without rate and secret."""
+        with override_settings(PROFILE_RATE=0, PROFILE_SECRET=None):
+            self.assertRaises(MiddlewareNotUsed, ProfileMiddleware)
+
+    def test_rate(self):
+        """Test ProfileMiddleware writes a profile per sampled request."""
+        with override_settings(PROFILE_RATE=1, PROFILE_SECRET=None,
+                               PROFILE_DIR=self.directory):
+            self.client.get(reverse('hello:home'))
+            self.client.get(reverse('hello:form'))
+        self.assertEqual(self.profiles(), ['form_page', 'home_page'])
+
+    def test_secret(self):
+        """Test ProfileMiddleware profiles requests with the secret."""
+        with override_settings(PROFILE_RATE=0, PROFILE_SECRET='s3cret',
+                               PROFILE_DIR=self.directory):
+            self.client.get(reverse('hello:home'))
+            self.client.get(reverse('hello:home'), HTTP_X_PROFILE='wrong')
+            self.assertEqual(self.profiles(), [])
+            self.client.get(reverse('hello:home'), HTTP_X_PROFILE='s3cret')
+        self.assertEqual(self.profiles(), ['home_page'])
+
+
+class RequestRulesTests(TestCase):
+    def test_rules_weight(self):
+        """Test first matching rule gives the weight of a request."""
+        rules = RequestRules((
+            ('/admin/', 0),
+            (r'^/(form|requests)/\d+/$', 0.5),
+            ('/requests/', 0.1),
+            ('/', 1),
+        ))
+        self.assertEqual(rules.weight('/admin/hello/'), 0)
+        self.assertEqual(rules.weight('/requests/12/'), 2)
+        self.assertEqual(rules.weight('/requests/'), 10)
+        self.assertEqual(rules.weight('/form/'), 1)
+        self.assertEqual(RequestRules(()).weight('/admin/'), 1)
+
+    def test_rules_sample(self):
+        """Test sampled requests are logged with their weight."""
+        rules = RequestRules((('/requests/', 0.1),))
+        random.seed(0)
+        weights = [rules.sample('/requests/') for i in range(1000)]
+        self.assertEqual(set(weights), set([0, 10]))
+        self.assertTrue(800 < sum(weights) < 1200)
+
+    def test_wrong_rules(self):
+        """Test wrong rules raise ImproperlyConfigured."""
+        with self.assertRaises(ImproperlyConfigured):
+            RequestRules((('/', 2),))
+        with self.assertRaises(ImproperlyConfigured):
+            RequestRules((('^/(', 1),))
+
+    @override_settings(REQUEST_LOG_RULES=(('/form/', 0), ('/', 0.5)))
+    def test_middleware_rules(self):
+        """Test middleware logs requests by REQUEST_LOG_RULES."""
+        path_cache.clear()
+        middleware = RequestMiddle()
+        request = RequestFactory().get(reverse('hello:form'))
+        request.user = AnonymousUser()
+        log_request(middleware, request, home_page)
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+        random.seed(0)
+        request = RequestFactory().get(reverse('hello:home'))
+        request.user = AnonymousUser()
+        for i in range(10):
+            log_request(middleware, request, home_page)
+        weights = RequestsStore.objects.values_list('weight', flat=True)
+        self.assertTrue(0 < len(weights) < 10)
+        self.assertEqual(set(weights), set([2]))
+
+
+class LRUCacheTests(TestCase):
+    def test_lru_cache(self):
+        """Test cache evicts least recently used key."""
+        cache = LRUCache(2)
+        cache.set('/', 0)
+        cache.set('/form/', 1)
+        self.assertEqual(cache.get('/'), 0)
+
+        # '/form/' wasn't used for longer, so it's evicted
+        cache.set('/requests/', 2)
+        self.assertNotIn('/form/', cache)
+        self.assertEqual(cache.get('/form/'), None)
+        self.assertEqual(len(cache), 2)
+
+        cache.delete('/')
+        self.assertEqual(cache.get('/', 5), 5)
+
+
+class NotifierTests(TestCase):
+    def test_notifier_wakes_waiters(self):
+        """Test wait returns when another thread notifies."""
+        notifier = Notifier()
+        version = notifier.version
+        timer = threading.Timer(0.01, notifier.notify)
+        timer.start()
+        self.assertEqual(notifier.wait(version, timeout=5), version + 1)
+        timer.join()
+
+        # changes made while nobody waited are not missed
+        notifier.notify()
+        start = time.time()
+        self.assertEqual(notifier.wait(version + 1, timeout=5), version + 2)
+        self.assertLess(time.time() - start, 1)
+
+        # nothing changed, wait gives up after timeout
+        self.assertEqual(notifier.wait(version + 2, timeout=0.01),
+                         version + 2)
+
+
+class BufferedWriterTests(TestCase):
+    def setUp(self):
+        self.path = RequestPath.objects.create(path='/')
+        path_cache.set('/', self.path.id)
+        RequestCounter.objects.incr(RequestCounter.UNREAD, 0)
+
+    def test_flush_on_batch_size(self):
+        """Test writer bulk inserts rows when batch is full."""
+        writer = BufferedWriter(batch_size=3, max_age=60, max_buffer=10)
+
+        writer.add(record('GET'))
+        writer.add(record('GET'))
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+        # third row fills the batch, all rows are written at once
+        # and counted as unread in the same savepoint
+        with self.assertNumQueries(4):
+            writer.add(record('POST'))
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(RequestsStore.objects.count(), 3)
+        self.assertEqual(
+            RequestCounter.objects.value(RequestCounter.UNREAD), 3)
+
+    def test_flush_on_batch_age(self):
+        """Test writer flushes rows older than max_age."""
+        writer = BufferedWriter(batch_size=100, max_age=0, max_buffer=10)
+        writer.add(record('GET'))
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(RequestsStore.objects.count(), 1)
+
+    def test_max_buffer_drops_oldest(self):
+        """Test writer keeps at most max_buffer newest rows."""
+        writer = BufferedWriter(batch_size=100, max_age=60, max_buffer=2)
+        for i in range(4):
+            writer.add(record('GET%s' % i))
+        self.assertEqual(len(writer), 2)
+
+        self.assertEqual(writer.flush(), 2)
+        methods = RequestsStore.objects.values_list('method', flat=True)
+        self.assertEqual(sorted(methods), ['GET2', 'GET3'])
+
+    @override_settings(REQUEST_LOG_ASYNC=False, REQUEST_LOG_BACKEND='database',
+                       REQUEST_LOG_BATCH_SIZE=50, REQUEST_LOG_BATCH_AGE=60)
+    def test_join_writes_buffer(self):
+        """Test writers.join writes rows buffered by a plain writer."""
+        writer = writers.create_writer()
+        self.addCleanup(writer.close)
+        writer.add(record('GET'))
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+        writers.join()
+        self.assertEqual(RequestsStore.objects.count(), 1)
+
+
+class FileWriterTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self, pattern='*'):
+        return sorted(glob.glob(os.path.join(self.directory, pattern)))
+
+    def test_file_writer(self):
+        """Test writer appends records as JSON lines, no rows."""
+        writer = FileWriter(directory=self.directory, batch_size=2,
+                            max_age=60, fsync=True)
+        writer.add(record('GET'))
+        self.assertEqual(self.segments(), [])
+
+        with self.assertNumQueries(0):
+            writer.add(record('POST', path='/form/'))
+        part, = self.segments()
+        self.assertTrue(part.endswith('.jsonl.part'))
+        with open(part) as lines:
+            records = [json.loads(line) for line in lines]
+        self.assertEqual([(r['method'], r['path']) for r in records],
+                         [('GET', '/'), ('POST', '/form/')])
+
+        # closed segment gets its final name
+        writer.close()
+        self.assertEqual(self.segments(), [part[:-len('.part')]])
+        self.assertEqual(RequestsStore.objects.count(), 0)
+
+    def test_file_writer_rotation(self):
+        """Test writer starts a new segment when one is full."""
+        writer = FileWriter(directory=self.directory, batch_size=1,
+                            max_bytes=1)
+        for i in range(3):
+            writer.add(record('GET'))
+        self.assertEqual(len(self.segments('*.jsonl')), 2)
+        self.assertEqual(len(self.segments('*.part')), 1)
+        writer.close()
+        self.assertEqual(len(self.segments('*.jsonl')), 3)
+
+    def test_file_writer_behind_queue(self):
+        """Test queue writer closes its file writer after draining."""
+        writer = QueueWriter(sink=FileWriter(directory=self.directory,
+                                             batch_size=50, max_age=60))
+        for i in range(120):
+            writer.add(record('GET'))
+        writer.close()
+
+        self.assertEqual(self.segments('*.part'), [])
+        segment, = self.segments('*.jsonl')
+        with open(segment) as lines:
+            self.assertEqual(len(lines.readlines()), 120)
+
+
+class ListSink(object):
+    """Stands in for BufferedWriter, keeps rows in a list."""
+    max_age = 0.1
+
+    def __init__(self):
+        self.rows = []
+        self.written = 0
+
+    def __len__(self):
+        return 0
+
+    def add(self, record):
+        self.rows.append(record)
+
+    def is_due(self):
+        return False
+
+    def flush(self):
+        self.written = len(self.rows)
+        return self.written
+
+    def close(self):
+        self.closed = True
+
+
+class QueueWriterTests(TestCase):
+    def stopped_writer(self, **kwargs):
+        """Writer without background thread, its queue is not drained."""
+        writer = QueueWriter(sink=ListSink(), maxsize=2, **kwargs)
+        writer.close()
+        for record in ('first', 'second', 'third'):
+            writer.add(record)
+        return writer
+
+    def test_worker_hands_records_to_sink(self):
+        """Test background thread drains the queue into the sink."""
+        sink = ListSink()
+        writer = QueueWriter(sink=sink, maxsize=10, policy='wait')
+        for record in ('first', 'second', 'third'):
+            writer.add(record)
+        writer.join()
+        self.assertIn(writer, writers._writers)
+        writer.close()
+
+        # closed writers are let go
+        self.assertNotIn(writer, writers._writers)
+        self.assertTrue(sink.closed)
+        self.assertEqual(sink.rows, ['first', 'second', 'third'])
+        self.assertEqual(writer.stats(), {
+            'queued': 3, 'dropped': 0, 'written': 3, 'pending': 0})
+
+    def test_full_queue_policies(self):
+        """Test what happens with a record when the queue is full."""
+        writer = self.stopped_writer(policy='drop_newest')
+        self.assertEqual(list(writer.queue.queue), ['first', 'second'])
+        self.assertEqual(writer.dropped, 1)
+
+        writer = self.stopped_writer(policy='drop_oldest')
+        self.assertEqual(list(writer.queue.queue), ['second', 'third'])
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.queued, 3)
+
+        writer = self.stopped_writer(policy='wait', timeout=0.01)
+        self.assertEqual(list(writer.queue.queue), ['first', 'second'])
+        self.assertEqual(writer.dropped, 1)
+
+        writer = self.stopped_writer(policy='sample', sample_rate=0)
+        self.assertEqual(list(writer.queue.queue), ['first', 'second'])
+
+        writer = self.stopped_writer(policy='sample', sample_rate=1)
+        self.assertEqual(list(writer.queue.queue), ['second', 'third'])
+
+    def test_unknown_policy(self):
+        """Test writer refuses policy it doesn't know."""
+        with self.assertRaises(ImproperlyConfigured):
+            QueueWriter(sink=ListSink(), policy='ignore')
@@ -4,15 +4,27 @@ from __future__ import unicode_literals
 from datetime import date
 from PIL import Image as Img
 import StringIO
+import os
+import shutil
+import sqlite3
+import tempfile
 
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.db import connection
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import EmailValidator
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
-from ..models import Contact, RequestsStore, NoteModel
+from ..models import Contact, RequestPath, RequestsStore, NoteModel
+from ..models import RequestCounter, images_total
+from ..cache import path_cache
+from ..db import set_pragmas
+from .. import images
+from ..images import process_image
 
 
 # create image file for test
@@ -121,10 +133,120 @@ class ContactModelTests(TestCase):
         self.assertTrue(person.height <= 200)
         self.assertTrue(person.width <= 200)
 
+    def test_person_image_processing(self):
+        """Test raw upload is made a thumbnail by process_image."""
+        person = Contact.objects.get(id=1)
+        person.image = get_temporary_image()
+        person.save()
+        self.assertEqual(person.image_state, Contact.READY)
+
+        # the raw upload is waiting for a pool thread
+        person.image.storage.save(person.image.name, get_temporary_image())
+        Contact.objects.filter(id=1).update(
+            image_state=Contact.PROCESSING, width=1200, height=700)
+        # update() sends no signal to clear the page
+        cache.clear()
+        response = self.client.get(reverse('hello:home'))
+        self.assertContains(response, 'Photo is being processed')
+
+        fields = process_image(1, person.image.name)
+        self.assertEqual(fields['image_state'], Contact.READY)
+        person = Contact.objects.get(id=1)
+        self.assertEqual(person.image_state, Contact.READY)
+        self.assertEqual((person.width, person.height), (200, 116))
+        self.assertEqual(Img.open(person.image.path).size, (200, 116))
+
+        # a variant per CONTACT_IMAGE_SIZES width, offered in srcset
+        self.assertEqual(person.image_widths, '100,200,400')
+        for name, width in person.image_variants():
+            self.assertEqual(
+                Img.open(person.image.storage.path(name)).size[0], width)
+        self.assertEqual(person.image_srcset(), ', '.join([
+            '/uploads/photo/test-100w.jpg 100w',
+            '/uploads/photo/test.jpg 200w',
+            '/uploads/photo/test-400w.jpg 400w']))
+        # cached page is cleared
+        response = self.client.get(reverse('hello:home'))
+        self.assertNotContains(response, 'Photo is being processed')
+        self.assertContains(response, 'sizes="200px"')
+
+        # variants are deleted with the contact
+        paths = [person.image.storage.path(name)
+                 for name, width in person.image_variants()]
+        person.delete()
+        self.assertFalse([path for path in paths if os.path.exists(path)])
+
+    @override_settings(IMAGE_ASYNC=True)
+    def test_person_image_pool(self):
+        """Test upload is made a thumbnail by the pool job."""
+        pool = JobsPool()
+        self.addCleanup(setattr, images, '_pool', images._pool)
+        images._pool = pool
+        person = Contact.objects.get(id=1)
+        person.image = get_temporary_image()
+        person.save()
+        self.assertEqual(person.image_state, Contact.PROCESSING)
+        self.assertEqual(Contact.objects.get(id=1).image_state,
+                         Contact.PROCESSING)
+
+        # run by a pool thread otherwise
+        [(func, args)] = pool.jobs
+        self.assertIs(func, images._process_in_pool)
+        func(*args)
+        person = Contact.objects.get(id=1)
+        self.assertEqual(person.image_state, Contact.READY)
+        self.assertTrue(person.width <= 200 and person.height <= 200)
+        self.assertEqual(Img.open(person.image.path).size,
+                         (person.width, person.height))
+        self.assertTrue(person.image_widths)
+
+    def test_person_image_failed(self):
+        """Test upload that is not an image is marked failed."""
+        person = Contact.objects.get(id=1)
+        # header tells the size, pixels are cut off
+        data = get_temporary_image().read()[:1000]
+        person.image = InMemoryUploadedFile(
+            StringIO.StringIO(data), None, 'cut.jpg', 'image/jpeg',
+            len(data), None)
+        person.save()
+        self.assertEqual(person.image_state, Contact.FAILED)
+        self.assertEqual(Contact.objects.get(id=1).image_state,
+                         Contact.FAILED)
+
+    def test_person_model_image_unchanged(self):
+        """Test saving a contact doesn't encode its stored photo again."""
+        person = Contact.objects.get(id=1)
+        person.image = get_temporary_image()
+        person.save()
+        with open(person.image.path, 'rb') as f:
+            thumbnail = f.read()
+
+        resized = images_total.labels('resized').samples()[0][2]
+        person = Contact.objects.get(id=1)
+        person.bio = 'Text only edit'
+        person.save()
+        self.assertEqual(images_total.labels('resized').samples()[0][2],
+                         resized)
+        with open(person.image.path, 'rb') as f:
+            self.assertEqual(f.read(), thumbnail)
+
+
+class JobsPool(object):
+    """Keeps jobs instead of running them in threads."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, func, args):
+        self.jobs.append((func, args))
+
 
 class RequestsStoreTest(TestCase):
     fixtures = ['data.json']
 
+    def setUp(self):
+        path_cache.clear()
+
     def test_request_store(self):
         """Test creating a new request and saving it to the database"""
 
@@ -135,15 +257,15 @@ class RequestsStoreTest(TestCase):
         with self.assertRaises(ValidationError) as err:
             request_store.full_clean()
         err_dict = err.exception.message_dict
-        self.assertEquals(err_dict['path'][0],
-                          RequestsStore._meta.get_field('path').
-                          error_messages['blank'])
+        self.assertEquals(err_dict['request_path'][0],
+                          RequestsStore._meta.get_field('request_path').
+                          error_messages['null'])
         self.assertEquals(err_dict['method'][0],
                           RequestsStore._meta.get_field('method').
                           error_messages['blank'])
 
         # test cretae and save object
-        request_store.path = '/'
+        request_store.request_path = RequestPath.objects.create(path='/')
         request_store.method = 'GET'
         request_store.user = user
 
@@ -157,7 +279,7 @@ class RequestsStoreTest(TestCase):
         self.assertEquals(str(only_request), str(request_store))
 
         # and check that it's saved its two attributes: path and method
-        self.assertEquals(only_request.path, '/')
+        self.assertEquals(only_request.request_path.path, '/')
         self.assertEquals(only_request.method, 'GET')
         self.assertEquals(only_request.new_request, 1)
         self.assertEquals(only_request.user, user)
@@ -172,9 +294,9 @@ class RequestsStoreTest(TestCase):
 
         # check record RequestStore contains:
         # method - 'GET' and default priority - 0
-        self.assertEqual(request_store.path, '/')
+        self.assertEqual(request_store.request_path.path, '/')
         self.assertEqual(request_store.method, 'GET')
-        self.assertEqual(request_store.priority, 0)
+        self.assertEqual(request_store.request_path.priority, 0)
 
     def test_change_record_priority_field(self):
         """
@@ -185,15 +307,58 @@ class RequestsStoreTest(TestCase):
         request_store = RequestsStore.objects.first()
 
         # change priority to 1 and send POST to home page
-        request_store.priority = 1
-        request_store.save()
+        request_path = request_store.request_path
+        request_path.priority = 1
+        request_path.save()
+        # admin changes reach request_ajax deltas too
+        self.assertEqual(RequestPath.objects.get().version, 1)
         self.client.post(reverse('hello:home'))
 
         # check record RequestStore contains:
         # method - 'POST' and priority - 1
         request_store = RequestsStore.objects.get(method='POST')
         self.assertEqual(request_store.method, 'POST')
-        self.assertEqual(request_store.priority, 1)
+        self.assertEqual(request_store.request_path.priority, 1)
+
+        # both records share one path
+        self.assertEqual(RequestPath.objects.count(), 1)
+
+    def test_unread_counter(self):
+        """
+        Test unread counter follows logged, saved and deleted requests.
+        """
+        unread = RequestCounter.UNREAD
+        self.assertEqual(RequestCounter.objects.value(unread), 0)
+
+        # logged by the middleware writer
+        self.client.get(reverse('hello:home'))
+        self.assertEqual(RequestCounter.objects.value(unread), 1)
+
+        # saved and deleted one by one
+        request_path = RequestPath.objects.get(path='/')
+        request_store = RequestsStore.objects.create(
+            request_path=request_path, method='GET')
+        RequestsStore.objects.create(
+            request_path=request_path, method='GET', new_request=0)
+        self.assertEqual(RequestCounter.objects.value(unread), 2)
+        request_store.delete()
+        self.assertEqual(RequestCounter.objects.value(unread), 1)
+
+        # saved read and unread again
+        request_store = RequestsStore.objects.get(new_request=1)
+        request_store.new_request = 0
+        request_store.save()
+        self.assertEqual(RequestCounter.objects.value(unread), 0)
+        request_store.save()
+        self.assertEqual(RequestCounter.objects.value(unread), 0)
+        request_store = RequestsStore.objects.get(id=request_store.id)
+        request_store.new_request = 1
+        request_store.save()
+        self.assertEqual(RequestCounter.objects.value(unread), 1)
+
+        # one row whatever the number of requests
+        self.assertEqual(
+            RequestCounter.objects.filter(name=unread).count(), 1)
 
 
 class NoteModelTestCase(TestCase):
@@ -211,10 +376,10 @@ class NoteModelTestCase(TestCase):
 
         # take all objects of NoteModel
         all_note = NoteModel.objects.all()
-        self.assertEqual(len(all_note), 13)
+        self.assertEqual(len(all_note), 16)
 
         # take note about person
-        only_note = all_note[12]
+        only_note = all_note[15]
         self.assertEqual(only_note.model, note_person.model)
         self.assertEqual(only_note.action_type, 0)
 
@@ -258,15 +423,15 @@ class NoteModelTestCase(TestCase):
         """
         # check created object after loaded fixtures
         all_note = NoteModel.objects.all()
-        self.assertEqual(len(all_note), 12)
-        only_note = all_note[11]
+        self.assertEqual(len(all_note), 15)
+        only_note = all_note[14]
         self.assertEqual(only_note.model, 'Contact')
 
         # delete object Person
         only_note.delete()
 
         # now NoteModel is empty
-        self.assertEqual(NoteModel.objects.count(), 11)
+        self.assertEqual(NoteModel.objects.count(), 14)
 
     def test_processor_not_creates_entry_db_if_change_inst_NoteModel(self):
         """
@@ -275,8 +440,8 @@ class NoteModelTestCase(TestCase):
         """
         # check created object after loaded fixtures
         all_note = NoteModel.objects.all()
-        self.assertEqual(len(all_note), 12)
-        only_note = all_note[11]
+        self.assertEqual(len(all_note), 15)
+        only_note = all_note[14]
         self.assertEqual(only_note.model, 'Contact')
 
         # change object Person
@@ -285,6 +450,27 @@ class NoteModelTestCase(TestCase):
 
         # now NoteModel has only one instance
         all_note = NoteModel.objects.all()
-        self.assertEqual(len(all_note), 12)
-        only_note = all_note[11]
+        self.assertEqual(len(all_note), 15)
+        only_note = all_note[14]
         self.assertEqual(only_note.model, 'RequestStore')
+
+
+class SqlitePragmasTest(TestCase):
+    def test_connection_pragmas(self):
+        """Test new connections run SQLITE_PRAGMAS."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA busy_timeout')
+        self.assertEqual(cursor.fetchone()[0], 5000)
+        cursor.execute('PRAGMA synchronous')
+        # NORMAL
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_set_pragmas(self):
+        """Test set_pragmas turns WAL journal on for a database file."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        db = sqlite3.connect(os.path.join(directory, 'db.sqlite3'))
+        set_pragmas(db.cursor(), [('journal_mode', 'WAL')])
+        self.assertEqual(
+            db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        db.close()
@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from datetime import date
+from datetime import date, datetime, timedelta
 import StringIO
+import json
 
 from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django.http import HttpRequest
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
 
 from ..views import home_page
-from ..models import Contact, RequestsStore
+from ..models import Contact, RequestPath, RequestsStore, RequestRollup
+from ..models import RequestCounter
 from .test_models import get_temporary_image
+from ..cache import path_cache
+from apps.metrics.registry import registry
 
 
 # create text file for test
@@ -28,6 +37,7 @@ class HomePageViewTest(TestCase):
     def setUp(self):
         # Every test needs access to the request factory.
         self.factory = RequestFactory()
+        cache.clear()
 
     def test_home_page_view(self):
         """Test view home_page"""
@@ -44,6 +54,7 @@ class HomePageViewTest(TestCase):
 
 class HomePageTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.person = Contact.objects.create(
             name='Aleks',
             surname='Woronow',
@@ -119,7 +130,58 @@ class HomePageTest(TestCase):
         self.assertTrue(response.content.strip().endswith(b'</html>'))
 
 
+class HomePageCacheTest(TestCase):
+    fixtures = ['data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def get(self, user):
+        request = self.factory.get('/')
+        request.user = user
+        return home_page(request)
+
+    def cache_lookups(self, result):
+        lines = registry.render().splitlines()
+        prefix = 'home_page_cache_total{result="%s"} ' % result
+        return sum(int(line[len(prefix):]) for line in lines
+                   if line.startswith(prefix))
+
+    def test_cached_variants(self):
+        """Test home page is cached for anonymous and logged in users."""
+        hits, misses = self.cache_lookups('hit'), self.cache_lookups('miss')
+        anonymous = self.get(AnonymousUser()).content
+        # no query and no rendering
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(AnonymousUser()).content, anonymous)
+
+        user = get_user_model().objects.get(id=1)
+        authenticated = self.get(user).content
+        self.assertIn(b'Log out', authenticated)
+        self.assertNotIn(b'Log out', anonymous)
+        self.assertEqual(self.get(user).content, authenticated)
+
+        self.assertEqual(self.cache_lookups('hit') - hits, 2)
+        self.assertEqual(self.cache_lookups('miss') - misses, 2)
+
+    def test_contact_signals_clear_cache(self):
+        """Test saving or deleting the contact clears cached pages."""
+        self.assertIn(b'Woronow', self.get(AnonymousUser()).content)
+        person = Contact.objects.get()
+        person.surname = 'Petrov'
+        person.save()
+        self.assertIn(b'Petrov', self.get(AnonymousUser()).content)
+
+        person.delete()
+        self.assertIn(b'Contact data no yet',
+                      self.get(AnonymousUser()).content)
+
+
 class RequestViewTest(TestCase):
+    def setUp(self):
+        path_cache.clear()
+
     def test_request_view(self):
         """Test request_view"""
 
@@ -132,7 +194,7 @@ class RequestViewTest(TestCase):
         home_request = all_requests[0]
 
         # check that new_request = 1
-        self.assertEquals(home_request.path, '/')
+        self.assertEquals(home_request.request_path.path, '/')
         self.assertEquals(home_request.new_request, 1)
 
         # send request to requests page
@@ -147,7 +209,7 @@ class RequestViewTest(TestCase):
         self.assertEquals(len(all_requests), 2)
         home_request = all_requests[0]
 
-        self.assertEquals(home_request.path, '/requests/')
+        self.assertEquals(home_request.request_path.path, '/requests/')
         self.assertEquals(home_request.new_request, 0)
 
         self.assertEqual(response.status_code, 200)
@@ -157,8 +219,45 @@ class RequestViewTest(TestCase):
         self.assertIn('Method', response.content)
         self.assertIn('Date', response.content)
 
+    def test_request_view_latency(self):
+        """Test request_view shows response time percentiles."""
+        home = RequestPath.objects.create(path='/')
+        form = RequestPath.objects.create(path='/form/')
+        for duration in range(1, 101):
+            RequestsStore.objects.create(request_path=home, method='GET',
+                                         duration=duration)
+        RequestsStore.objects.create(request_path=form, method='GET',
+                                     duration=500, weight=10)
+        # not timed
+        RequestsStore.objects.create(request_path=form, method='GET')
+
+        response = self.client.get(reverse('hello:requests'))
+        latency = response.context['latency']
+        self.assertEqual([row['path'] for row in latency], ['/form/', '/'])
+        self.assertEqual(latency[0]['requests'], 10)
+        self.assertEqual((latency[1]['p50'], latency[1]['p95'],
+                          latency[1]['p99']), (50, 95, 99))
+        self.assertContains(response, 'Latency')
+
+    def test_request_view_history(self):
+        """Test request_view shows rolled up requests."""
+        home = RequestPath.objects.create(path='/')
+        hour = datetime(2016, 3, 1, 10, tzinfo=timezone.utc)
+        RequestRollup.objects.create(request_path=home, method='GET',
+                                     hour=hour, hits=7)
+        RequestRollup.objects.create(request_path=home, method='GET',
+                                     hour=hour + timedelta(hours=1), hits=5)
+
+        response = self.client.get(reverse('hello:requests'))
+        self.assertContains(response, 'History')
+        self.assertEqual(response.context['history'][0]['hits'], 12)
+        self.assertContains(response, '<td>12</td>', html=True)
+
 
 class RequestAjaxTest(TestCase):
+    def setUp(self):
+        path_cache.clear()
+
     def test_request_ajax_view(self):
         """Test request ajax view"""
         self.client.get(reverse('hello:home'))
@@ -170,6 +269,130 @@ class RequestAjaxTest(TestCase):
         self.assertIn('path', response.content)
         self.assertIn('/', response.content)
 
+    def test_request_ajax_unread_count(self):
+        """
+        Test request_ajax view reads unread count from the counter
+        and viewed=yes resets it.
+        """
+        self.client.get(reverse('hello:home'))
+        self.client.get(reverse('hello:home'))
+
+        # validator, then counter and the list without a count
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                reverse('hello:requests_ajax'),
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(response.content)[0], 2)
+
+        response = self.client.get(reverse('hello:requests_ajax'),
+                                   {'viewed': 'yes'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(response.content)[0], 0)
+        self.assertEqual(
+            RequestCounter.objects.value(RequestCounter.UNREAD), 0)
+
+    def test_request_ajax_etag(self):
+        """
+        Test request_ajax view answers 304 until the request log changes.
+        """
+        url = reverse('hello:requests_ajax')
+        self.client.get(reverse('hello:home'))
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        etag = response['ETag']
+
+        # counters and newest id only, nothing is serialized
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # unread requests are marked as read despite the validator
+        response = self.client.get(
+            url, {'viewed': 'yes'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        # priority change gives a new validator
+        self.client.post(url, {'path': '/', 'priority': 2},
+                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        response = self.client.get(
+            url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(json.loads(response.content)[1])[0]
+                         ['fields']['priority'], 2)
+
+        # and so does a new request
+        etag = response['ETag']
+        self.client.get(reverse('hello:home'))
+        response = self.client.get(
+            url, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_request_ajax_delta(self):
+        """
+        Test request_ajax view with since_id sends only what changed
+        since the cursor.
+        """
+        def delta(**cursor):
+            response = self.client.get(
+                reverse('hello:requests_ajax'), cursor,
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            return json.loads(response.content)
+
+        self.client.get(reverse('hello:home'))
+        self.client.get(reverse('hello:form'))
+
+        # no cursor yet, ten newest requests
+        data = delta(since_id=0)
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['unread'], 2)
+        self.assertEqual(data['requests']['columns'], [
+            'pk', 'path', 'method', 'date', 'new_request', 'priority'])
+        self.assertEqual([row[1] for row in data['requests']['rows']],
+                         ['/form/', '/'])
+        cursor = dict(since_id=data['last_id'], version=data['version'],
+                      changes=data['changes'])
+
+        # nothing changed
+        with self.assertNumQueries(2):
+            data = delta(**cursor)
+        self.assertFalse(data['reset'])
+        self.assertEqual(data['requests']['rows'], [])
+        self.assertEqual(data['priorities'], {})
+
+        # new request and priority change
+        self.client.get(reverse('hello:home'))
+        self.client.post(reverse('hello:requests_ajax'),
+                         {'path': '/form/', 'priority': 3},
+                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = delta(**cursor)
+        self.assertFalse(data['reset'])
+        self.assertEqual(data['unread'], 3)
+        self.assertEqual(len(data['requests']['rows']), 1)
+        self.assertEqual(data['requests']['rows'][0][0],
+                         cursor['since_id'] + 1)
+        self.assertEqual(data['priorities'], {'/form/': 3})
+        self.assertEqual(data['version'], cursor['version'] + 1)
+
+        # deleted request, client starts over
+        RequestsStore.objects.first().delete()
+        data = delta(**cursor)
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['requests']['rows']), 2)
+
+        response = self.client.get(reverse('hello:requests_ajax'),
+                                   {'since_id': 'last'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
     def test_request_ajax_content_empty_db(self):
         """
         Test check that request_ajax view returns
@@ -195,7 +418,9 @@ class RequestAjaxTest(TestCase):
         for i in range(1, 15):
             path = '/test%s' % i
             method = 'GET'
-            RequestsStore.objects.create(path=path, method=method, priority=i)
+            request_path = RequestPath.objects.create(path=path, priority=i)
+            RequestsStore.objects.create(request_path=request_path,
+                                         method=method)
 
         self.client.get(reverse('hello:home'))
         request_store_count = RequestsStore.objects.count()
@@ -225,9 +450,9 @@ class RequestAjaxTest(TestCase):
         all_req = RequestsStore.objects.all()
         self.assertEquals(len(all_req), 1)
         only_req = all_req[0]
-        self.assertEqual(only_req.path, '/')
+        self.assertEqual(only_req.request_path.path, '/')
         self.assertEqual(only_req.method, 'GET')
-        self.assertEqual(only_req.priority, 0)
+        self.assertEqual(only_req.request_path.priority, 0)
 
         data = {'path': '/', 'priority': 1}
         # send new priority
@@ -239,9 +464,14 @@ class RequestAjaxTest(TestCase):
         all_req = RequestsStore.objects.all()
         self.assertEquals(len(all_req), 1)
         only_req = all_req[0]
-        self.assertEquals(only_req.path, '/')
+        self.assertEquals(only_req.request_path.path, '/')
         self.assertEquals(only_req.method, 'GET')
-        self.assertEquals(only_req.priority, 1)
+        self.assertEquals(only_req.request_path.priority, 1)
+
+        # requests logged after the change get the new priority
+        self.client.get(reverse('hello:home'))
+        self.assertEquals(
+            RequestsStore.objects.first().request_path.priority, 1)
 
     def test_requests_ajax_view_sort_requests_list(self):
         """
@@ -253,16 +483,42 @@ class RequestAjaxTest(TestCase):
 
         # now in RequestsStore
         all_req = RequestsStore.objects.all()
-        self.assertEquals(all_req[0].path, '/')
-        self.assertEquals(all_req[1].path, '/form/')
-        self.assertEquals(all_req[2].path, '/')
+        self.assertEquals(all_req[0].request_path.path, '/')
+        self.assertEquals(all_req[1].request_path.path, '/form/')
+        self.assertEquals(all_req[2].request_path.path, '/')
 
         # check that response is sorted by path
         response = self.client.get(reverse('hello:requests_ajax'),
                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
-        self.assertEqual('"path\\": \\"/\\"', (response.content[-453:-439]))
-        self.assertEqual('"path\\": \\"/\\"', (response.content[-259:-245]))
-        self.assertEqual('"path\\": \\"/form/\\"', (response.content[-65:-46]))
+        new_request, list_req = json.loads(response.content)
+        paths = [req['fields']['path'] for req in json.loads(list_req)]
+        self.assertEqual(paths, ['/', '/', '/form/'])
+
+
+class RequestStreamTest(TestCase):
+    def setUp(self):
+        path_cache.clear()
+
+    @override_settings(REQUEST_STREAM_MAX_AGE=0)
+    def test_request_stream(self):
+        """Test request_stream sends request_ajax delta as an event."""
+        self.client.get(reverse('hello:home'))
+        response = self.client.get(reverse('hello:requests_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.streaming)
+
+        # stream of max age 0 ends after the first event
+        events = list(response.streaming_content)
+        self.assertEqual(len(events), 1)
+        version, data = events[0].splitlines()[:2]
+        self.assertTrue(version.startswith('id: '))
+        delta = json.loads(data[len('data: '):])
+        self.assertTrue(delta['reset'])
+        self.assertEqual(delta['unread'], 1)
+        self.assertEqual(delta['requests']['rows'][0][1], '/')
+
+        # stream requests are not logged
+        self.assertEqual(RequestsStore.objects.count(), 1)
 
 
 class FormPageTest(TestCase):
@@ -11,5 +11,7 @@ urlpatterns = patterns(
     url(r'^$', views.home_page, name='home'),
     url(r'^requests/$', views.request_view, name='requests'),
     url(r'^requests_ajax/$', views.request_ajax, name='requests_ajax'),
+    url(r'^requests_stream/$', views.request_stream,
+        name='requests_stream'),
     url(r'^form/$', views.form_page, name='form'),
 )
@@ -2,58 +2,289 @@
 from __future__ import unicode_literals
 
 import json
+import math
 import time
+from collections import defaultdict
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.http import HttpResponseBadRequest
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min, Sum
 
-from .models import Contact, RequestsStore
+from .models import Contact, RequestPath, RequestsStore, RequestRollup
+from .models import RequestCounter
 from .decorator import not_record_request
 from .forms import ContactForm
+from apps.hello.cache import home_page_key
+from apps.hello.events import request_log_changed
+from apps.metrics.registry import registry
+
+
+home_page_cache_total = registry.counter(
+    'home_page_cache_total', 'home_page cache lookups by result',
+    ('result',))
 
 
 def home_page(request):
+    """
+    The page is cached for anonymous and for authenticated users, Contact
+    signals clear it, a hit neither queries nor renders.
+    """
+    key = home_page_key(request)
+    content = cache.get(key)
+    if content is not None:
+        home_page_cache_total.labels('hit').inc()
+        return HttpResponse(content)
+    home_page_cache_total.labels('miss').inc()
+
     context = {}
     person = Contact.objects.first()
     context['person'] = person
-    return render(request, 'home.html', context)
+    response = render(request, 'home.html', context)
+    cache.set(key, response.content, settings.HOME_PAGE_CACHE_TIMEOUT)
+    return response
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted values."""
+    rank = int(math.ceil(percent / 100. * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+def latency_percentiles(limit):
+    """
+    Response time percentiles of paths over limit newest timed
+    requests, the slowest paths first.
+    """
+    rows = RequestsStore.objects.filter(duration__isnull=False)\
+        .values_list('request_path__path', 'duration', 'weight')[:limit]
+    durations = defaultdict(list)
+    requests = defaultdict(int)
+    for path, duration, weight in rows:
+        durations[path].append(duration)
+        requests[path] += weight
+
+    latency = []
+    for path, values in durations.items():
+        values.sort()
+        latency.append({
+            'path': path,
+            'requests': requests[path],
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+        })
+    latency.sort(key=lambda row: row['p95'], reverse=True)
+    return latency
 
 
 def request_view(request):
-    return render(request, 'requests.html')
+    history = RequestRollup.objects.order_by()\
+        .values('request_path__path', 'method')\
+        .annotate(hits=Sum('hits'), first=Min('hour'), last=Max('hour'))\
+        .order_by('-hits')[:10]
+    latency = latency_percentiles(settings.REQUEST_LATENCY_ROWS)[:10]
+    return render(request, 'requests.html',
+                  {'history': history, 'latency': latency})
+
+
+# request_ajax delta columns: RequestsStore lookups and their names
+REQUEST_COLUMNS = (
+    ('id', 'pk'),
+    ('request_path__path', 'path'),
+    ('method', 'method'),
+    ('date', 'date'),
+    ('new_request', 'new_request'),
+    ('request_path__priority', 'priority'),
+)
+
+
+def request_columns(queryset):
+    """
+    Rows of the queryset as a column names list and a list of value
+    lists, read with values_list: no model instances, every column
+    name is sent once.
+    """
+    lookups, names = zip(*REQUEST_COLUMNS)
+    return {
+        'columns': names,
+        'rows': list(queryset.values_list(*lookups)),
+    }
+
+
+def serialize_requests(request_list):
+    return json.dumps([{
+        'pk': req.pk,
+        'fields': {
+            'path': req.request_path.path,
+            'method': req.method,
+            'date': req.date,
+            'new_request': req.new_request,
+            'priority': req.request_path.priority,
+        }} for req in request_list], cls=DjangoJSONEncoder)
+
+
+def log_state():
+    """
+    Cursor of the request log as request_ajax shows it: newest request
+    id and the unread, priorities and changes counters.
+    """
+    names = [RequestCounter.UNREAD, RequestCounter.PRIORITIES,
+             RequestCounter.CHANGES]
+    counters = dict(RequestCounter.objects.filter(name__in=names)
+                    .values_list('name', 'value'))
+    state = dict((name, counters.get(name, 0)) for name in names)
+    state['last_id'] = RequestsStore.objects.order_by('-id')\
+        .values_list('id', flat=True).first() or 0
+    return state
+
+
+def log_version(state):
+    return '%(last_id)s-%(unread)s-%(priorities)s-%(changes)s' % state
+
+
+def requests_etag(request):
+    """
+    ETag of request_ajax payload. None turns conditional GET off
+    for requests that change the log.
+    """
+    if request.method != 'GET' or not request.is_ajax():
+        return None
+    state = log_state()
+    if state['unread'] and request.GET.get('viewed') == 'yes':
+        return None
+    # request_ajax builds a delta from the same state
+    request.log_state = state
+    return log_version(state)
+
+
+def requests_payload():
+    """Unread count and ten newest requests sorted by path."""
+    new_request = RequestCounter.objects.value(RequestCounter.UNREAD)
+    request_list = RequestsStore.objects.select_related('request_path')
+    request_list = list(request_list[:10])
+    request_list.sort(key=lambda a: a.request_path.path)
+    list_req = serialize_requests(request_list)
+    return json.dumps((new_request, list_req))
+
+
+def requests_delta(state, since_id=0, version=None, changes=None):
+    """
+    What changed since the client's cursor: requests newer than since_id
+    and priorities changed after version. The client starts over with
+    ten newest requests when it has no cursor yet or requests were
+    edited or deleted since (reset).
+    """
+    reset = not since_id or changes != state['changes']
+    request_list = RequestsStore.objects.none()
+    if reset or since_id < state['last_id']:
+        request_list = RequestsStore.objects.all()
+        if not reset:
+            request_list = request_list.filter(id__gt=since_id)
+        request_list = request_list[:10]
+    priorities = {}
+    if not reset and version is not None \
+            and version < state['priorities']:
+        priorities = dict(RequestPath.objects.filter(version__gt=version)
+                          .values_list('path', 'priority'))
+    return json.dumps({
+        'unread': state['unread'],
+        'last_id': state['last_id'],
+        'version': state['priorities'],
+        'changes': state['changes'],
+        'reset': reset,
+        'requests': request_columns(request_list),
+        'priorities': priorities,
+    }, cls=DjangoJSONEncoder, separators=(',', ':'))
 
 
 @not_record_request
+@condition(etag_func=requests_etag)
 def request_ajax(request):
     if request.is_ajax():
         if request.method == 'POST':
             path = request.POST['path']
             priority = request.POST['priority']
             if int(priority) >= 0:
-                RequestsStore.objects.filter(path=path)\
-                                    .update(priority=priority)
+                with transaction.atomic():
+                    version = RequestCounter.objects.next(
+                        RequestCounter.PRIORITIES)
+                    RequestPath.objects.filter(path=path)\
+                                       .update(priority=priority,
+                                               version=version)
+                request_log_changed.notify()
             return HttpResponse(json.dumps({'response': 'ok'}),
                                 content_type='application/json')
 
         viewed = request.GET.get('viewed')
         if viewed == 'yes':
-            RequestsStore.objects.filter(new_request=1).update(new_request=0)
-
-        new_request = RequestsStore.objects.filter(new_request=1).count()
-        request_list = RequestsStore.objects.all()[:10]
-        request_list = list(request_list)
-        request_list.sort(key=lambda a: a.path)
-        list_req = serializers.serialize("json", request_list)
-        data = json.dumps((new_request, list_req))
+            with transaction.atomic():
+                count = RequestsStore.objects.filter(new_request=1)\
+                    .update(new_request=0)
+                RequestCounter.objects.incr(RequestCounter.UNREAD, -count)
+            request_log_changed.notify()
+
+        if 'since_id' not in request.GET:
+            return HttpResponse(requests_payload(),
+                                content_type="application/json")
+
+        try:
+            cursor = [int(request.GET[name]) if request.GET.get(name)
+                      else None
+                      for name in ('since_id', 'version', 'changes')]
+        except ValueError:
+            return HttpResponseBadRequest('Error cursor')
+        state = getattr(request, 'log_state', None) or log_state()
+        data = requests_delta(state, cursor[0] or 0, *cursor[1:])
         return HttpResponse(data, content_type="application/json")
 
     return HttpResponseBadRequest('Error request')
 
 
+@not_record_request
+def request_stream(request):
+    """
+    Server-sent events with request_ajax deltas, the stream keeps the
+    cursor itself. The generator sleeps until this process logs
+    a request or changes the log, and checks the log version at least
+    every REQUEST_STREAM_KEEPALIVE seconds for changes made by other
+    processes. The stream ends after REQUEST_STREAM_MAX_AGE seconds
+    and EventSource opens a new one.
+    """
+    def events():
+        deadline = time.time() + settings.REQUEST_STREAM_MAX_AGE
+        changed = request_log_changed.version
+        sent = None
+        cursor = (0, None, None)
+        while True:
+            state = log_state()
+            version = log_version(state)
+            if version != sent:
+                sent = version
+                data = requests_delta(state, *cursor)
+                cursor = (state['last_id'], state['priorities'],
+                          state['changes'])
+                yield 'id: %s\ndata: %s\n\n' % (version, data)
+            else:
+                yield ': keepalive\n\n'
+            if time.time() >= deadline:
+                return
+            changed = request_log_changed.wait(
+                changed, settings.REQUEST_STREAM_KEEPALIVE)
+
+    response = StreamingHttpResponse(events(),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 @login_required(login_url='/login/')
 def form_page(request):
     person = Contact.objects.first()
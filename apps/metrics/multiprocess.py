@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import glob
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+
+
+INITIAL_SIZE = 64 * 1024
+HEADER = struct.Struct(b'<Q')
+KEY_LENGTH = struct.Struct(b'<I')
+VALUE = struct.Struct(b'<d')
+
+ARCHIVE = 'metrics-archive.db'
+
+
+class MmapFile(object):
+    """
+    Metric values of a process in a memory mapped file:
+
+    * 8 bytes - number of used bytes, header included
+    * entries - 4 bytes key length, utf-8 key padded to 8 bytes
+      together with its length, 8 bytes double value
+
+    Entries are only appended and the used bytes are updated after the
+    entry is written, so other processes can read the file any time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size < INITIAL_SIZE:
+            self._file.truncate(INITIAL_SIZE)
+        self._map()
+        self.used = HEADER.unpack_from(self._mm, 0)[0] or HEADER.size
+        self._offsets = dict((key, offset) for key, offset, value
+                             in read_entries(self._mm))
+
+    def _map(self):
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), size)
+
+    def _append(self, key):
+        data = key.encode('utf-8')
+        padded = (KEY_LENGTH.size + len(data) + 7) & ~7
+        end = self.used + padded + VALUE.size
+        if end > len(self._mm):
+            self._mm.close()
+            self._file.truncate(max(end, 2 * os.fstat(
+                self._file.fileno()).st_size))
+            self._map()
+        KEY_LENGTH.pack_into(self._mm, self.used, len(data))
+        start = self.used + KEY_LENGTH.size
+        self._mm[start:start + len(data)] = data
+        offset = self.used + padded
+        VALUE.pack_into(self._mm, offset, 0)
+        self.used = end
+        HEADER.pack_into(self._mm, 0, end)
+        self._offsets[key] = offset
+        return offset
+
+    def value(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            return 0
+        return VALUE.unpack_from(self._mm, offset)[0]
+
+    def set(self, key, value):
+        offset = self._offsets.get(key) or self._append(key)
+        VALUE.pack_into(self._mm, offset, value)
+
+    def add(self, key, amount):
+        offset = self._offsets.get(key) or self._append(key)
+        value = VALUE.unpack_from(self._mm, offset)[0]
+        VALUE.pack_into(self._mm, offset, value + amount)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+def read_entries(mm):
+    """Key, offset and value of every complete entry of a mapped file."""
+    used = min(HEADER.unpack_from(mm, 0)[0], len(mm))
+    position = HEADER.size
+    while position + KEY_LENGTH.size <= used:
+        length = KEY_LENGTH.unpack_from(mm, position)[0]
+        offset = position + ((KEY_LENGTH.size + length + 7) & ~7)
+        if offset + VALUE.size > used:
+            break
+        start = position + KEY_LENGTH.size
+        key = mm[start:start + length].decode('utf-8')
+        yield key, offset, VALUE.unpack_from(mm, offset)[0]
+        position = offset + VALUE.size
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return [(key, value) for key, offset, value
+                    in read_entries(mm)]
+        finally:
+            mm.close()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class MmapStore(object):
+    """
+    Metric values of every worker process, a metrics-<pid>.db file per
+    worker in directory. A forked worker opens its own file on first
+    write. Counters and histograms of dead workers are added to
+    metrics-archive.db and their files are removed, gauges of dead
+    workers are dropped.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._pid = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _own_file(self):
+        if self._pid != os.getpid():
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._pid = os.getpid()
+            self._file = MmapFile(os.path.join(
+                self.directory, 'metrics-%d.db' % self._pid))
+        return self._file
+
+    def add(self, key, amount):
+        with self._lock:
+            self._own_file().add(key, amount)
+
+    def set(self, key, value):
+        with self._lock:
+            self._own_file().set(key, value)
+
+    def value(self, key):
+        with self._lock:
+            return self._own_file().value(key)
+
+    def collect(self):
+        """Values of live workers and the archive summed by key."""
+        totals = {}
+        pattern = re.compile(r'metrics-(\d+)\.db$')
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.db')):
+            match = pattern.search(path)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            if pid != os.getpid() and not is_alive(pid):
+                self.archive(path)
+                continue
+            for key, value in read_file(path):
+                totals[key] = totals.get(key, 0) + value
+
+        archive = os.path.join(self.directory, ARCHIVE)
+        if os.path.exists(archive):
+            for key, value in read_file(archive):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def archive(self, path):
+        """Moves counters and histograms of a dead worker's file."""
+        with open(os.path.join(self.directory, ARCHIVE + '.lock'),
+                  'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another scrape was first
+            if not os.path.exists(path):
+                return
+            archive = MmapFile(os.path.join(self.directory, ARCHIVE))
+            try:
+                for key, value in read_file(path):
+                    if json.loads(key)[0] != 'gauge':
+                        archive.add(key, value)
+            finally:
+                archive.close()
+            os.remove(path)
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import bisect
+import json
+import threading
+import weakref
+
+from django.conf import settings
+
+from .multiprocess import MmapStore
+
+
+# seconds, from a fast view to a slow image upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Owner(object):
+    """Kept in a thread's local storage, so it is freed with the thread."""
+
+
+class Cells(object):
+    """
+    Per thread lists of numbers. A thread only ever changes its own
+    list, so updates need no lock: the lock is taken once per thread
+    to register its list and when the lists are summed. When a thread
+    ends its list is folded into a shared total, so servers starting
+    a thread per request don't collect lists.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._total = [0] * size
+        self._cells = {}
+        self._local = threading.local()
+        # reentrant: a weakref callback may run while the lock is held
+        self._lock = threading.RLock()
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+            owner = self._local.owner = _Owner()
+            with self._lock:
+                self._cells[weakref.ref(owner, self._fold)] = cell
+            return cell
+
+    def _fold(self, ref):
+        with self._lock:
+            cell = self._cells.pop(ref, None)
+            if cell is not None:
+                self._total = [a + b for a, b in zip(self._total, cell)]
+
+    def add(self, index, amount):
+        self._cell()[index] += amount
+
+    def values(self):
+        with self._lock:
+            cells = [self._total] + list(self._cells.values())
+        return [sum(values) for values in zip(*cells)]
+
+
+class StoreCells(object):
+    """Numbers of a metric kept in a MmapStore, shared by processes."""
+
+    def __init__(self, store, key, size):
+        self.store = store
+        self.keys = [json.dumps(key + [index]) for index in range(size)]
+
+    def add(self, index, amount):
+        self.store.add(self.keys[index], amount)
+
+    def set(self, index, value):
+        self.store.set(self.keys[index], value)
+
+    def values(self):
+        return [self.store.value(key) for key in self.keys]
+
+
+class Metric(object):
+    """Metric of one set of label values."""
+    size = 1
+
+    def __init__(self, family, label_values):
+        self.family = family
+        self._cells = family.registry.cells(
+            [family.kind, family.name, list(label_values)], self.size)
+
+    def samples(self, values=None):
+        """Samples: name suffix, extra labels, value."""
+        return [('', (), (values or self._cells.values())[0])]
+
+
+class Counter(Metric):
+    def inc(self, amount=1):
+        self._cells.add(0, amount)
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a function."""
+
+    def __init__(self, family, label_values):
+        super(Gauge, self).__init__(family, label_values)
+        self.function = None
+        self._lock = threading.Lock()
+        if isinstance(self._cells, Cells):
+            # set() needs the last value, not a sum of thread values
+            self._value = [0]
+
+    def set(self, value):
+        if isinstance(self._cells, Cells):
+            self._value[0] = value
+        else:
+            self._cells.set(0, value)
+
+    def inc(self, amount=1):
+        if isinstance(self._cells, Cells):
+            with self._lock:
+                self._value[0] += amount
+        else:
+            self._cells.add(0, amount)
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self, values=None):
+        if self.function is not None:
+            value = self.function()
+        elif values is not None:
+            value = values[0]
+        elif isinstance(self._cells, Cells):
+            value = self._value[0]
+        else:
+            value = self._cells.values()[0]
+        return [('', (), value)]
+
+
+class Histogram(Metric):
+    """Counts of observations per fixed bucket, their sum and count."""
+
+    def __init__(self, family, label_values):
+        # a count per bucket, +Inf bucket, sum
+        self.size = len(family.buckets) + 2
+        super(Histogram, self).__init__(family, label_values)
+        self.buckets = family.buckets
+
+    def observe(self, value):
+        self._cells.add(bisect.bisect_left(self.buckets, value), 1)
+        self._cells.add(self.size - 1, value)
+
+    def samples(self, values=None):
+        values = values or self._cells.values()
+        samples = []
+        count = 0
+        for bound, value in zip(self.buckets + ('+Inf',), values):
+            count += value
+            samples.append(('_bucket', (('le', format_value(bound)),),
+                            count))
+        samples.append(('_sum', (), values[-1]))
+        samples.append(('_count', (), count))
+        return samples
+
+
+class Family(object):
+    """Metrics of one name, a metric per set of label values."""
+
+    def __init__(self, registry, kind, name, help, labels=(), buckets=None):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.label_names)
+        values = tuple(unicode(value) for value in values)
+        try:
+            return self._metrics[values]
+        except KeyError:
+            if len(values) != len(self.label_names):
+                raise ValueError('%s labels are %s, got %s' % (
+                    self.name, ', '.join(self.label_names), values))
+            with self._lock:
+                if values not in self._metrics:
+                    self._metrics[values] = METRICS[self.kind](self, values)
+                return self._metrics[values]
+
+    def __getattr__(self, name):
+        # metric without labels: family.inc(), family.observe(1)
+        if self.label_names or name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.labels(), name)
+
+    def collect(self, stored=None):
+        """
+        Samples of the family: name, labels, value. stored maps label
+        values to values of metrics kept by other processes too.
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        for values in stored or ():
+            if values not in metrics:
+                metrics[values] = self.labels(*values)
+        for values, metric in sorted(metrics.items()):
+            labels = tuple(zip(self.label_names, values))
+            for suffix, extra, value in metric.samples(
+                    (stored or {}).get(values)):
+                yield self.name + suffix, labels + extra, value
+
+
+METRICS = {
+    'counter': Counter,
+    'gauge': Gauge,
+    'histogram': Histogram,
+}
+
+
+class Registry(object):
+    """
+    Metric families by name. Asking for a family twice returns the same
+    one, so modules may declare the metrics they feed at import time.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def cells(self, key, size):
+        if self.store is None:
+            return Cells(size)
+        return StoreCells(self.store, key, size)
+
+    def family(self, kind, name, help, labels=(), buckets=None):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = Family(
+                    self, kind, name, help, labels, buckets)
+            elif family.kind != kind:
+                raise ValueError('%s is a %s' % (name, family.kind))
+            return family
+
+    def counter(self, name, help, labels=()):
+        return self.family('counter', name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.family('gauge', name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.family('histogram', name, help, labels, buckets)
+
+    def families(self):
+        with self._lock:
+            return sorted(self._families.values(), key=lambda f: f.name)
+
+    def stored(self):
+        """Values of every process by family name and label values."""
+        stored = {}
+        for key, value in self.store.collect().items():
+            kind, name, label_values, index = json.loads(key)
+            values = stored.setdefault(name, {}).setdefault(
+                tuple(label_values), [])
+            values.extend([0] * (index + 1 - len(values)))
+            values[index] = value
+        return stored
+
+    def render(self):
+        """Registry in Prometheus text format."""
+        stored = self.stored() if self.store is not None else {}
+        lines = []
+        for family in self.families():
+            lines.append('# HELP %s %s' % (family.name, family.help))
+            lines.append('# TYPE %s %s' % (family.name, family.kind))
+            for name, labels, value in family.collect(
+                    stored.get(family.name)):
+                lines.append('%s%s %s' % (name, format_labels(labels),
+                                          format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', r'\\')
+                     .replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels)
+
+
+def format_value(value):
+    # stored values are floats
+    if isinstance(value, float):
+        return unicode(int(value)) if value.is_integer() else repr(value)
+    return unicode(value)
+
+
+# metrics of this process, or of every worker process with METRICS_DIR
+registry = Registry(
+    MmapStore(settings.METRICS_DIR) if settings.METRICS_DIR else None)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.http import HttpResponse
+
+from apps.hello.decorator import not_record_request
+from .registry import registry
+
+
+@not_record_request
+def metrics(request):
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4')
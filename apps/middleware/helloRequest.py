@@ -2,31 +2,120 @@
 from __future__ import unicode_literals
 
 import logging
+import time
 
-from apps.hello.models import RequestsStore
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from apps.metrics.registry import registry
+from .queries import query_stats
+from .rules import RequestRules
+from .writers import create_writer
 
 
 logger = logging.getLogger(__name__)
 
+requests_total = registry.counter(
+    'http_requests_total', 'Requests by view, method and status',
+    ('view', 'method', 'status'))
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Response time by view', ('view',))
+query_warnings_total = registry.counter(
+    'http_query_warnings_total',
+    'Requests over the query budget or repeating a statement, by view',
+    ('view', 'reason'))
+
 
 class RequestMiddle(object):
+    def __init__(self):
+        self.writer = create_writer()
+        self.rules = RequestRules(settings.REQUEST_LOG_RULES)
+
+    def process_request(self, request):
+        request._log_started = time.time()
+        if settings.REQUEST_LOG_QUERIES:
+            # connection.queries is only kept by the debug cursor
+            request._log_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            request._log_queries = len(connection.queries)
+
     def process_view(self, request, view_func, *view_args, **view_kwargs):
+        request._metrics_view = view_func.__name__
         log_msg = '%s %s' % (request.method, request.path)
 
+        weight = 0
         if not getattr(view_func, 'not_record', False):
-            req = RequestsStore()
-            req.path = request.path
-            req.method = request.method
+            weight = self.rules.sample(request.path)
 
-            existent_reg = RequestsStore.objects\
-                .filter(path=request.path).first()
-            if existent_reg is not None:
-                req.priority = existent_reg.priority
+        if weight:
+            # writers turn records into RequestsStore rows or file lines
+            req = {
+                'path': request.path,
+                'method': request.method,
+                'user_id': None,
+                'date': timezone.now(),
+                'weight': weight,
+            }
 
             if request.user.is_authenticated():
-                req.user = request.user
+                req['user_id'] = request.user.id
 
-            req.save()
+            # written with the response timings
+            request._log_record = req
             logger.info(log_msg + ' was saved')
         else:
             logger.info(log_msg + ' wasn\'t saved')
+
+    def process_response(self, request, response):
+        queries = None
+        if hasattr(request, '_log_queries'):
+            queries = connection.queries[request._log_queries:]
+            connection.use_debug_cursor = request._log_debug_cursor
+            if settings.QUERY_ACCOUNTING:
+                self.check_queries(request, response, query_stats(
+                    queries, settings.QUERY_REPEAT_LIMIT))
+            queries = len(queries)
+
+        duration = None
+        if hasattr(request, '_log_started'):
+            duration = time.time() - request._log_started
+            # requests that matched no view, 404 included
+            view = getattr(request, '_metrics_view', 'none')
+            requests_total.labels(view, request.method,
+                                  response.status_code).inc()
+            request_seconds.labels(view).observe(duration)
+
+        req = getattr(request, '_log_record', None)
+        if req is not None:
+            req['duration'] = duration * 1000
+            req['status'] = response.status_code
+            req['size'] = None if response.streaming \
+                else len(response.content)
+            req['queries'] = queries
+            self.writer.add(req)
+        return response
+
+    def check_queries(self, request, response, stats):
+        """
+        Warns of requests over QUERY_BUDGET queries or repeating a
+        statement QUERY_REPEAT_LIMIT times, N+1 queries most likely.
+        With QUERY_HEADERS every response tells its queries.
+        """
+        view = getattr(request, '_metrics_view', 'none')
+        if stats['count'] > settings.QUERY_BUDGET:
+            query_warnings_total.labels(view, 'budget').inc()
+            logger.warning('%s %s ran %d queries, budget is %d' % (
+                request.method, request.path, stats['count'],
+                settings.QUERY_BUDGET))
+        for sql, count in stats['repeats']:
+            query_warnings_total.labels(view, 'repeat').inc()
+            logger.warning('%s %s repeated %d times: %s' % (
+                request.method, request.path, count, sql))
+
+        if settings.QUERY_HEADERS:
+            response['X-Query-Count'] = str(stats['count'])
+            response['X-Query-Time'] = '%.3f' % stats['time']
+            if stats['repeats']:
+                response['X-Query-Repeats'] = str(sum(
+                    count for sql, count in stats['repeats']))
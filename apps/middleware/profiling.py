@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import cProfile
+import os
+import random
+import threading
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+
+class ProfileMiddleware(object):
+    """
+    Profiles PROFILE_RATE of requests, and requests whose X-Profile
+    header is PROFILE_SECRET, from the view to the response, and dumps
+    every profile to PROFILE_DIR as <view>-<time>-<pid>-<thread>.prof.
+    manage.py profilestats merges them by view. Not used when both
+    settings are off.
+
+    Must be the last middleware, so the others don't count.
+    """
+
+    def __init__(self):
+        self.rate = settings.PROFILE_RATE
+        self.secret = settings.PROFILE_SECRET
+        if not self.rate and not self.secret:
+            raise MiddlewareNotUsed
+        self.directory = settings.PROFILE_DIR
+
+    def should_profile(self, request):
+        header = request.META.get('HTTP_X_PROFILE')
+        if self.secret and header:
+            return constant_time_compare(header, self.secret)
+        return random.random() < self.rate
+
+    def process_view(self, request, view_func, *view_args, **view_kwargs):
+        if self.should_profile(request):
+            request._profile_view = view_func.__name__
+            # cProfile only sees the thread that enabled it
+            request._profile = cProfile.Profile()
+            request._profile.enable()
+
+    def process_response(self, request, response):
+        profile = getattr(request, '_profile', None)
+        if profile is not None:
+            profile.disable()
+            self.dump(profile, request._profile_view)
+        return response
+
+    def dump(self, profile, view):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another thread meanwhile
+                if not os.path.isdir(self.directory):
+                    raise
+        name = '%s-%s-%d-%d.prof' % (
+            view, timezone.now().strftime('%Y%m%d%H%M%S%f'), os.getpid(),
+            threading.current_thread().ident)
+        profile.dump_stats(os.path.join(self.directory, name))
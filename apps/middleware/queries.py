@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ast
+import re
+from collections import Counter
+
+
+# sqlite debug cursor keeps the statement and its parameters apart
+SQLITE = re.compile(r"^QUERY = (u?'.*'|u?\".*\") - PARAMS = .*$", re.S)
+# literals of other backends, parameters are filled in
+PARAMETER = re.compile(r'%s')
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+SPACE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """
+    Statement of a query without its values, so queries that differ
+    only by parameters compare equal: WHERE id = 1 and WHERE id = 2
+    are both WHERE id = ?, IN lists of any length are IN (...).
+    """
+    match = SQLITE.match(sql)
+    if match:
+        sql = PARAMETER.sub('?', ast.literal_eval(match.group(1)))
+    sql = STRING.sub('?', sql)
+    sql = NUMBER.sub('?', sql)
+    sql = IN_LIST.sub('(...)', sql)
+    return SPACE.sub(' ', sql).strip()
+
+
+def query_stats(queries, repeat_limit):
+    """
+    Count, total seconds and statements run repeat_limit times or more
+    of connection.queries items, most repeated first.
+    """
+    statements = Counter()
+    # fewer queries can't repeat a statement enough, normalize is slow
+    if len(queries) >= repeat_limit:
+        statements.update(normalize(query['sql']) for query in queries)
+    return {
+        'count': len(queries),
+        'time': sum(float(query['time']) for query in queries),
+        'repeats': [(sql, count) for sql, count in statements.most_common()
+                    if count >= repeat_limit],
+    }
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+class RequestRules(object):
+    """
+    Decides which requests RequestMiddle logs. Rules are (pattern, rate)
+    pairs: pattern is a path prefix, or a regular expression when it
+    starts with ^. The first matching rule wins, paths no rule matches
+    are logged. With rate 0 requests are not logged, with 1 all of them
+    are, in between every N-th request on average is logged with
+    weight N, where N is 1 / rate rounded.
+
+    All patterns are compiled into one regular expression, so a path
+    is matched once whatever the number of rules.
+    """
+
+    def __init__(self, rules):
+        self.weights = []
+        patterns = []
+        for pattern, rate in rules:
+            if not 0 <= rate <= 1:
+                raise ImproperlyConfigured(
+                    'REQUEST_LOG_RULES rate of "%s" should be between '
+                    '0 and 1, got %s' % (pattern, rate))
+            if not pattern.startswith('^'):
+                pattern = '^' + re.escape(pattern)
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ImproperlyConfigured(
+                    'REQUEST_LOG_RULES pattern "%s" is wrong: %s'
+                    % (pattern, e))
+            # outer group of a match closes last, lastgroup names it
+            patterns.append('(?P<rule%d>%s)' % (len(patterns), pattern))
+            self.weights.append(int(round(1. / rate)) if rate else 0)
+        self.regex = re.compile('|'.join(patterns)) if patterns else None
+
+    def weight(self, path):
+        """Weight of a request logged by the rules, 0 if not logged."""
+        match = self.regex and self.regex.match(path)
+        if not match:
+            return 1
+        return self.weights[int(match.lastgroup[len('rule'):])]
+
+    def sample(self, path):
+        """Weight of the request when it should be logged, else 0."""
+        weight = self.weight(path)
+        if weight > 1 and random.random() * weight >= 1:
+            return 0
+        return weight
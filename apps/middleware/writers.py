@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import Queue
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.hello.models import RequestCounter, RequestPath, RequestsStore
+from apps.hello.cache import path_cache
+from apps.hello.events import request_log_changed
+from apps.metrics.registry import registry
+
+
+logger = logging.getLogger(__name__)
+
+# writers closed at exit: queue writers and the ones create_writer made,
+# closed ones remove themselves
+_writers = []
+
+
+def get_path_id(path):
+    path_id = path_cache.get(path)
+    if path_id is None:
+        path_id = RequestPath.objects.get_or_create(path=path)[0].id
+        path_cache.set(path, path_id)
+    return path_id
+
+
+def request_row(record):
+    """RequestsStore row of a request record made by RequestMiddle."""
+    return RequestsStore(request_path_id=get_path_id(record['path']),
+                         method=record['method'],
+                         user_id=record['user_id'],
+                         date=record['date'],
+                         weight=record['weight'],
+                         duration=record.get('duration'),
+                         status=record.get('status'),
+                         size=record.get('size'),
+                         queries=record.get('queries'))
+
+
+class BufferedWriter(object):
+    """
+    Collects request records in memory and writes them as RequestsStore
+    rows with one bulk_create when the buffer reaches batch_size records
+    or its oldest record is older than max_age seconds. Records that
+    could not be written stay in the buffer, which never grows past
+    max_buffer records: the oldest ones are dropped first.
+    """
+
+    def __init__(self, batch_size=None, max_age=None, max_buffer=None):
+        self.batch_size = batch_size or settings.REQUEST_LOG_BATCH_SIZE
+        self.max_age = max_age if max_age is not None \
+            else settings.REQUEST_LOG_BATCH_AGE
+        self.max_buffer = max_buffer or settings.REQUEST_LOG_MAX_BUFFER
+        self._buffer = []
+        self._first_added = None
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, record):
+        with self._lock:
+            if not self._buffer:
+                self._first_added = time.time()
+            self._buffer.append(record)
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                logger.warning('Request log buffer is full, '
+                               '%d records dropped' % overflow)
+        if self.is_due():
+            self.flush()
+
+    def is_due(self):
+        if not self._buffer:
+            return False
+        if len(self._buffer) >= self.batch_size:
+            return True
+        return time.time() - self._first_added >= self.max_age
+
+    def flush(self):
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            self._first_added = None
+        if not records:
+            return 0
+
+        try:
+            self.write(records)
+        except Exception:
+            logger.exception('Request log flush of %d records failed'
+                             % len(records))
+            with self._lock:
+                self._buffer[:0] = records
+                del self._buffer[:-self.max_buffer]
+                self._first_added = time.time()
+            return 0
+
+        with self._lock:
+            self.written += len(records)
+        return len(records)
+
+    def join(self):
+        """Writes buffered records, as QueueWriter.join does."""
+        self.flush()
+
+    def close(self):
+        """Writes buffered records."""
+        try:
+            _writers.remove(self)
+        except ValueError:
+            pass
+        self.flush()
+
+    def write(self, records):
+        rows = [request_row(record) for record in records]
+        with transaction.atomic():
+            RequestsStore.objects.bulk_create(rows)
+            # new rows are unread
+            RequestCounter.objects.incr(RequestCounter.UNREAD, len(rows))
+        request_log_changed.notify()
+
+
+class FileWriter(BufferedWriter):
+    """
+    Appends request records as JSON lines to a segment file in directory
+    instead of writing database rows, one write per batch, followed by
+    fsync when fsync is on. The segment being written is named
+    *.jsonl.part. It is closed and renamed to *.jsonl once it grows past
+    max_bytes or gets older than max_file_age seconds, and on exit.
+    manage.py importrequests loads closed segments into RequestsStore.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, max_file_age=None,
+                 fsync=None, **kwargs):
+        super(FileWriter, self).__init__(**kwargs)
+        self.directory = directory or settings.REQUEST_LOG_FILE_DIR
+        self.max_bytes = max_bytes or settings.REQUEST_LOG_FILE_MAX_BYTES
+        self.max_file_age = max_file_age or settings.REQUEST_LOG_FILE_MAX_AGE
+        self.fsync = fsync if fsync is not None \
+            else settings.REQUEST_LOG_FILE_FSYNC
+        self._file = None
+        self._opened = None
+        self._file_lock = threading.Lock()
+
+    def write(self, records):
+        data = ''.join(json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+                       for record in records).encode('utf-8')
+        with self._file_lock:
+            if self._file is not None and (
+                    self._file.tell() >= self.max_bytes or
+                    time.time() - self._opened >= self.max_file_age):
+                self._rotate()
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = 'requests-%s-%d.jsonl.part' % (
+            timezone.now().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._opened = time.time()
+
+    def _rotate(self):
+        self._file.close()
+        os.rename(self._file.name, self._file.name[:-len('.part')])
+        self._file = None
+
+    def close(self):
+        """Writes buffered records and closes the segment."""
+        super(FileWriter, self).close()
+        with self._file_lock:
+            if self._file is not None:
+                self._rotate()
+
+
+class QueueWriter(object):
+    """
+    Puts rows on a bounded queue that a background thread drains into
+    a BufferedWriter, so no request waits for the database. When the
+    queue is full the policy decides what happens to the new row:
+
+    * wait - wait up to timeout seconds for a free slot, then drop
+      the new row
+    * drop_newest - drop the new row
+    * drop_oldest - drop the oldest queued row to make room
+    * sample - keep the new row with probability sample_rate,
+      in place of the oldest queued one
+    """
+
+    POLICIES = ('wait', 'drop_newest', 'drop_oldest', 'sample')
+
+    def __init__(self, sink=None, maxsize=None, policy=None,
+                 timeout=None, sample_rate=None):
+        self.sink = sink if sink is not None else BufferedWriter()
+        self.policy = policy or settings.REQUEST_LOG_QUEUE_POLICY
+        if self.policy not in self.POLICIES:
+            raise ImproperlyConfigured(
+                'REQUEST_LOG_QUEUE_POLICY should be one of %s, got "%s"'
+                % (', '.join(self.POLICIES), self.policy))
+        self.timeout = timeout if timeout is not None \
+            else settings.REQUEST_LOG_QUEUE_TIMEOUT
+        self.sample_rate = sample_rate if sample_rate is not None \
+            else settings.REQUEST_LOG_QUEUE_SAMPLE_RATE
+        self.queue = Queue.Queue(
+            maxsize or settings.REQUEST_LOG_QUEUE_SIZE)
+
+        self.queued = 0
+        self.dropped = 0
+        self._stats_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='request-log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        _writers.append(self)
+
+    def add(self, record):
+        if self.policy == 'wait':
+            try:
+                self.queue.put(record, timeout=self.timeout)
+            except Queue.Full:
+                return self._count(dropped=1)
+            return self._count(queued=1)
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if self.policy == 'drop_newest' or (
+                    self.policy == 'sample' and
+                    random.random() >= self.sample_rate):
+                return self._count(dropped=1)
+            self._replace_oldest(record)
+        else:
+            self._count(queued=1)
+
+    def _replace_oldest(self, record):
+        try:
+            self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        else:
+            self.queue.task_done()
+            self._count(dropped=1)
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self._count(dropped=1)
+        else:
+            self._count(queued=1)
+
+    def _count(self, queued=0, dropped=0):
+        with self._stats_lock:
+            self.queued += queued
+            if dropped:
+                if not self.dropped:
+                    logger.warning('Request log queue is full, records '
+                                   'are dropped (policy "%s")'
+                                   % self.policy)
+                self.dropped += dropped
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queued': self.queued,
+                'dropped': self.dropped,
+                'written': self.sink.written,
+                'pending': self.queue.qsize(),
+            }
+
+    def _run(self):
+        try:
+            self._drain()
+        finally:
+            # no request closes the connection of this thread
+            connection.close()
+
+    def _drain(self):
+        poll = min(self.sink.max_age, 1) or 0.1
+        while True:
+            try:
+                record = self.queue.get(timeout=poll)
+            except Queue.Empty:
+                if self.sink.is_due():
+                    self.sink.flush()
+                continue
+
+            if record is None:
+                self.sink.flush()
+                self.queue.task_done()
+                return
+
+            self.sink.add(record)
+            self.queue.task_done()
+
+    def join(self):
+        """Waits until every queued row was handed to the sink."""
+        # nothing drains the queue of a closed writer
+        if not self._thread.is_alive():
+            return
+        self.queue.join()
+        self.sink.flush()
+
+    def close(self, timeout=5):
+        """Drains the queue into the sink, then closes the sink."""
+        try:
+            _writers.remove(self)
+        except ValueError:
+            pass
+        if not self._thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            logger.warning('Request log writer did not stop, %d records '
+                           'are lost' % self.queue.qsize())
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('Request log writer did not stop in %s seconds'
+                           % timeout)
+            return
+        # a FileWriter renames its last segment, nothing writes after it
+        self.sink.close()
+
+
+BACKENDS = {
+    'database': BufferedWriter,
+    'file': FileWriter,
+}
+
+
+def create_writer():
+    """Request log writer configured by REQUEST_LOG_* settings."""
+    try:
+        backend = BACKENDS[settings.REQUEST_LOG_BACKEND]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'REQUEST_LOG_BACKEND should be one of %s, got "%s"'
+            % (', '.join(sorted(BACKENDS)), settings.REQUEST_LOG_BACKEND))
+    if settings.REQUEST_LOG_ASYNC:
+        return QueueWriter(sink=backend())
+    writer = backend()
+    _writers.append(writer)
+    return writer
+
+
+def join():
+    """Waits until writers of this process wrote their records."""
+    for writer in list(_writers):
+        writer.join()
+
+
+def close():
+    """Closes writers of this process, their records are written."""
+    for writer in list(_writers):
+        writer.close()
+
+
+atexit.register(close)
+
+
+def stats():
+    """Summed counters of every queue writer of this process."""
+    total = dict.fromkeys(('queued', 'dropped', 'written', 'pending'), 0)
+    for writer in list(_writers):
+        if not isinstance(writer, QueueWriter):
+            continue
+        for key, value in writer.stats().items():
+            total[key] += value
+    return total
+
+
+writer_stats = registry.gauge(
+    'request_log_queue', 'Request log queue writers records by state',
+    ('state',))
+for state in ('queued', 'dropped', 'written', 'pending'):
+    writer_stats.labels(state).set_function(
+        lambda state=state: stats()[state])
@@ -1,66 +1,135 @@
 var helloRequest = (function($){
+  var unread = 0;
+
+  // what the table shows, request_ajax sends only what changed since
+  var cursor = {'since_id': 0, 'version': '', 'changes': ''};
+
+  function requestRow(val) {
+    return $('<tr id="'+ val.pk +'">'
+        + '<td class="path">' + val.path + '</td>'
+        + '<td>' + val.method + '</td>'
+        + '<td>' + val.date + '</td>'
+        + '<td class="priority">' + val.priority + '</td>'
+        + '<td class="td_click plus" style="cursor: pointer;">\
+                <span class="glyphicon glyphicon-plus" aria-hidden="true">\
+                </span></td>'
+        + '<td class="td_click" style="cursor: pointer;">\
+                <span class="glyphicon glyphicon-minus" aria-hidden="true">\
+                </span></td>'
+        + '</tr>'
+    ).addClass(parseInt(val.new_request, 10) == 1 ? 'info' : 'old');
+  }
 
   function handleRequest(data) {
-    var items = [];
-    var id = data[0];
+    var tbody = $('#request').find('tbody');
+    unread = data.unread;
+    cursor = {
+        'since_id': data.last_id,
+        'version': data.version,
+        'changes': data.changes
+    };
+
+    if (data.reset) {
+        tbody.empty();
+    }
+    // requests come as column names and rows of values
+    var columns = data.requests.columns;
+    $.each(data.requests.rows, function(i, row) {
+        var val = {};
+        $.each(columns, function(j, name) {
+            val[name] = row[j];
+        });
+        if ( !document.getElementById(val.pk) ) {
+            tbody.append(requestRow(val));
+        }
+    });
+    $.each(data.priorities, function(path, priority) {
+        tbody.find('td.path').filter(function(){
+            return $(this).text() == path;
+        }).siblings('td.priority').text(priority);
+    });
+    if ( !unread ) {
+        tbody.find('tr.info').removeClass('info').addClass('old');
+    }
 
-    $.each(JSON.parse(data[1]), function(i, val) {
-        
-        var req_class = 'old';
-        if (parseInt(val.fields.new_request, 10) == 1){
-            req_class = 'info';
+    // ten newest requests, the most important first
+    var rows = tbody.children('tr').get();
+    rows.sort(function(a, b){ return b.id - a.id; });
+    $(rows.slice(10)).remove();
+    rows = rows.slice(0, 10);
+    rows.sort(function(a, b){
+        var pa = parseInt($(a).find('td.priority').text(), 10);
+        var pb = parseInt($(b).find('td.priority').text(), 10);
+        if (pa != pb) {
+            return pb - pa;
         }
-        items.push('<tr class="' + req_class + '" id="'+ val.pk +'">'
-            + '<td class="path">' + val.fields.path + '</td>'
-            + '<td>' + val.fields.method + '</td>'
-            + '<td>' + val.fields.date + '</td>'
-            + '<td class="priority">' + val.fields.priority + '</td>'
-            + '<td class="td_click plus" style="cursor: pointer;">\
-                    <span class="glyphicon glyphicon-plus" aria-hidden="true">\
-                    </span></td>'
-            + '<td class="td_click" style="cursor: pointer;">\
-                    <span class="glyphicon glyphicon-minus" aria-hidden="true">\
-                    </span></td>'
-            + '</tr>'
-        );
-         
-   });
-   items.sort(function(a, b){
-       return parseInt(
-           $(a).find('td.priority').text()) > parseInt($(b).find('td.priority').text()) ? -1 : 1;
-   });
+        return $(a).find('td.path').text() < $(b).find('td.path').text() ? -1 : 1;
+    });
+    tbody.append(rows);
 
-   var title = $('title').text().split(')')[1] || $('title').text();
-   var pre_titile = id ? '(' + id + ')' : '';
-   $('#request').find('tbody').html(items);
-   $('td').addClass('text-center');
-   $('th').addClass('text-center');
-   $('title').text(pre_titile + title);
+    var title = $('title').text().split(')')[1] || $('title').text();
+    var pre_titile = unread ? '(' + unread + ')' : '';
+    $('td').addClass('text-center');
+    $('th').addClass('text-center');
+    $('title').text(pre_titile + title);
  }
 
  return {
      loadRequest: function(){
         var viewed = '';
-        if ( document.hasFocus() ) {
+        if ( document.hasFocus() && unread ) {
             viewed = 'yes';
         } 
         $.ajax({
             url: '/requests_ajax/',
             dataType : "json",
-            data: {'viewed': viewed},
+            data: $.extend({'viewed': viewed}, cursor),
+            // sends ETag back in If-None-Match, 304 means no changes
+            ifModified: true,
             success: function(data, textStatus) {
-                handleRequest(data);
+                if (textStatus != 'notmodified') {
+                    handleRequest(data);
+                }
             },
             error: function(jqXHR) {
                 console.log(jqXHR.responseText);
             }
         });
+     },
+
+     // new requests are pushed by the server, polling is the fallback
+     listen: function(){
+        var self = this;
+        if ( !window.EventSource ) {
+            return self.poll();
+        }
+        var source = new EventSource('/requests_stream/');
+        source.onmessage = function(event) {
+            handleRequest(JSON.parse(event.data));
+            if ( document.hasFocus() && unread ) {
+                self.loadRequest();
+            }
+        };
+        source.onerror = function() {
+            // closed streams are not reopened by the browser
+            if ( source.readyState == EventSource.CLOSED ) {
+                self.poll();
+            }
+        };
+        $(window).focus(function(){
+            if ( unread ) {
+                self.loadRequest();
+            }
+        });
+     },
+
+     poll: function(){
+        this.loadRequest();
+        setInterval(this.loadRequest, 500);
      }
  };
 })(jQuery);
 
 $(document).ready(function(){
-    helloRequest.loadRequest();
-    setInterval(helloRequest.loadRequest, 500);
-    
+    helloRequest.listen();
 });
@@ -3,3 +3,8 @@ try:
     from .local import *    # noqa
 except ImportError:
     pass
+
+# settings following DEBUG of the environment unless set
+for _name in ('REQUEST_LOG_QUERIES', 'QUERY_ACCOUNTING', 'QUERY_HEADERS'):
+    if globals()[_name] is None:
+        globals()[_name] = DEBUG    # noqa
@@ -55,6 +55,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'apps.middleware.helloRequest.RequestMiddle',
+    'apps.middleware.profiling.ProfileMiddleware',
 )
 
 ROOT_URLCONF = 'fortytwo_test_task.urls'
@@ -72,6 +73,41 @@ DATABASES = {
     }
 }
 
+# Pragmas every new sqlite connection runs. With WAL journal readers don't
+# wait for the request log writer and it doesn't wait for them,
+# busy_timeout (ms) makes a connection wait for a lock instead of failing
+# with "database is locked". NORMAL synchronous is safe with WAL.
+# manage.py benchsqlite compares them with sqlite defaults.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),
+)
+
+# Local memory cache is per process: a Contact change clears the home_page
+# cache of the process that saved it, other processes serve their copy
+# until HOME_PAGE_CACHE_TIMEOUT seconds pass. A shared backend such as
+# memcached clears it everywhere.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+HOME_PAGE_CACHE_TIMEOUT = 300
+
+# Contact photos are saved as uploaded and made into thumbnails by
+# IMAGE_POOL_SIZE threads of the process, or right away without IMAGE_ASYNC
+IMAGE_ASYNC = True
+IMAGE_POOL_SIZE = 2
+
+# Contact photo is shown at most CONTACT_IMAGE_SIZE pixels wide and high,
+# variants of at most CONTACT_IMAGE_SIZES pixels are offered in srcset for
+# small and high density screens
+CONTACT_IMAGE_SIZE = 200
+CONTACT_IMAGE_SIZES = (100, 200, 400)
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -132,6 +168,93 @@ TEMPLATE_DIRS = (
 SOUTH_TESTS_MIGRATE = False
 
 
+# Request log (apps.middleware.helloRequest.RequestMiddle)
+# Rows are written with one bulk insert once REQUEST_LOG_BATCH_SIZE rows
+# are buffered or the oldest one is REQUEST_LOG_BATCH_AGE seconds old.
+# At most REQUEST_LOG_MAX_BUFFER rows are kept if the database is down.
+REQUEST_LOG_BATCH_SIZE = 50
+REQUEST_LOG_BATCH_AGE = 5
+REQUEST_LOG_MAX_BUFFER = 1000
+
+# With REQUEST_LOG_ASYNC rows go through a queue of REQUEST_LOG_QUEUE_SIZE
+# records, written to the database by a background thread. When the queue
+# is full REQUEST_LOG_QUEUE_POLICY decides what happens to a new record:
+# 'wait' waits up to REQUEST_LOG_QUEUE_TIMEOUT seconds for a free slot,
+# 'drop_newest' and 'drop_oldest' drop a record, 'sample' keeps
+# REQUEST_LOG_QUEUE_SAMPLE_RATE of new records in place of the oldest ones.
+REQUEST_LOG_ASYNC = True
+REQUEST_LOG_QUEUE_SIZE = 10000
+REQUEST_LOG_QUEUE_POLICY = 'drop_oldest'
+REQUEST_LOG_QUEUE_TIMEOUT = 0.05
+REQUEST_LOG_QUEUE_SAMPLE_RATE = 0.1
+
+# REQUEST_LOG_BACKEND 'database' writes RequestsStore rows, 'file' appends
+# JSON lines to segments in REQUEST_LOG_FILE_DIR instead, each segment is
+# closed once it is REQUEST_LOG_FILE_MAX_BYTES long or REQUEST_LOG_FILE_MAX_AGE
+# seconds old (checked on write) and on exit. With REQUEST_LOG_FILE_FSYNC
+# every batch is fsynced. manage.py importrequests loads closed segments.
+REQUEST_LOG_BACKEND = 'database'
+REQUEST_LOG_FILE_DIR = os.path.join(BASE_DIR, 'request_log')
+REQUEST_LOG_FILE_MAX_BYTES = 64 * 1024 * 1024
+REQUEST_LOG_FILE_MAX_AGE = 3600
+REQUEST_LOG_FILE_FSYNC = False
+
+# Count database queries of logged requests, needs the debug cursor that
+# keeps connection.queries during the request. The debug cursor costs time
+# and memory on every query. None follows DEBUG, as settings.local sets it
+REQUEST_LOG_QUERIES = None
+
+# With REQUEST_LOG_QUERIES and QUERY_ACCOUNTING requests running more than
+# QUERY_BUDGET queries or a statement QUERY_REPEAT_LIMIT times with
+# different parameters are logged as warnings. Finding repeats parses every
+# statement of the request. QUERY_HEADERS adds X-Query-Count, X-Query-Time
+# and X-Query-Repeats headers to responses. None follows DEBUG.
+QUERY_ACCOUNTING = None
+QUERY_BUDGET = 20
+QUERY_REPEAT_LIMIT = 5
+QUERY_HEADERS = None
+
+# Latency percentiles of the requests page are taken from
+# REQUEST_LATENCY_ROWS newest timed requests
+REQUEST_LATENCY_ROWS = 10000
+
+# Directory of memory mapped metric files shared by worker processes,
+# a process serves only its own /metrics when it's not set. The
+# directory must be emptied before the server starts.
+METRICS_DIR = os.getenv('METRICS_DIR')
+
+# ProfileMiddleware profiles PROFILE_RATE of requests (0.01 is one in a
+# hundred) and requests with an X-Profile: PROFILE_SECRET header, and writes
+# the profiles to PROFILE_DIR for manage.py profilestats
+PROFILE_RATE = 0
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+# Number of paths whose RequestPath id RequestMiddle keeps in memory
+REQUEST_PATH_CACHE_SIZE = 1000
+
+# Which requests RequestMiddle logs: (pattern, rate) pairs, pattern is
+# a path prefix or a regular expression starting with ^. The first
+# matching rule wins, 0 rate turns logging off, rate 0.1 logs every tenth
+# request with weight 10. Paths no rule matches are all logged.
+REQUEST_LOG_RULES = (
+    ('/admin/', 0),
+    ('/static/', 0),
+    ('/media/', 0),
+)
+
+# manage.py rolluprequests folds requests older than
+# REQUEST_LOG_RETENTION_DAYS into hourly RequestRollup counters and deletes
+# them, REQUEST_LOG_ROLLUP_CHUNK requests per transaction
+REQUEST_LOG_RETENTION_DAYS = 30
+REQUEST_LOG_ROLLUP_CHUNK = 500
+
+# /requests_stream/ checks the request log at least every
+# REQUEST_STREAM_KEEPALIVE seconds and is closed after REQUEST_STREAM_MAX_AGE
+# seconds, so a stream doesn't hold a server thread forever
+REQUEST_STREAM_KEEPALIVE = 15
+REQUEST_STREAM_MAX_AGE = 300
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -160,5 +283,21 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
         },
+        'apps.middleware.writers': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
+        },
+        'apps.hello.management.commands.rolluprequests': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
+        },
+        'apps.hello.management.commands.importrequests': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
+        },
+        'apps.hello.images': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
+        },
     },
 }
@@ -0,0 +1,9 @@
+# Settings of make test
+from . import *    # noqa
+
+# Tests check RequestsStore right after a request, and other threads can't
+# see the in-memory test database, so the request log is written and
+# photos are made in place
+REQUEST_LOG_ASYNC = False
+REQUEST_LOG_BATCH_SIZE = 1
+IMAGE_ASYNC = False
@@ -8,6 +8,7 @@ from django.contrib.auth import views as auth_views
 from django.contrib import admin
 
 from hello.forms import LoginForm
+from apps.metrics.views import metrics
 
 admin.autodiscover()
 
@@ -20,6 +21,7 @@ urlpatterns = patterns(
         {'authentication_form': LoginForm},
         name='login'),
     url(r'^logout/$', auth_views.logout, name='logout'),
+    url(r'^metrics$', metrics, name='metrics'),
 
     url(r'^admin/', include(admin.site.urls)),
 )